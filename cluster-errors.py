@@ -12,7 +12,7 @@ import sklearn.decomposition
 import sklearn.svm
 import sklearn.linear_model
 
-from utils.eval_utils import get_joint_accuracy, get_name_accuracy, print_turn, remove_none_slots
+from utils.eval_utils import get_joint_accuracy, get_name_accuracy, remove_none_slots, iter_predictions, find_predictions
 from utils.augment import EXPERIMENT_DOMAINS, ALL_SLOTS
 
 ExampleTuple = collections.namedtuple('ExampleTuple',
@@ -240,37 +240,48 @@ def load_data():
 
 
 def load_predictions(all_models):
-    pred_data_all = dict()
+    # the files are only read by compute_examples, one turn at a time
+    pred_files = dict()
     for modelname in all_models:
-        with open('./model-' + modelname + '/predictions/full/prediction_TRADE_dev.json') as fp:
-            pred_data = json.load(fp)
-            pred_data_all[modelname] = pred_data
-    return pred_data_all
+        pred_files[modelname] = find_predictions('./model-' + modelname + '/predictions/full/prediction_TRADE_dev')
+    return pred_files
 
 
-def compute_examples(dialogue_dev_data, pred_data):
+def compute_examples(dialogue_dev_data, pred_file):
     examples = []
+    for dialogue_id, turn_idx, turn in iter_predictions(pred_file):
+        annotation = list(remove_none_slots(turn['turn_belief']))
+        annotation.sort()
+        prediction = list(remove_none_slots(turn['pred_bs_ptr']))
+        prediction.sort()
 
+        joint_accuracy = get_joint_accuracy(turn)
+
+        examples.append(ExampleTuple(dialogue_dev_data[dialogue_id], turn_idx, annotation, prediction,
+                                     previous=None, label=joint_accuracy, features=dict()))
+
+    # the predictions are in decoding order, chain the turns in the order of the dataset
+    order = dict((dialogue_id, i) for i, dialogue_id in enumerate(dialogue_dev_data))
+    examples.sort(key=lambda ex: (order[ex.dialogue['dialogue_idx']], ex.turn_idx))
     previous = None
-    for dialogue_id, dialogue in dialogue_dev_data.items():
-        for turn in dialogue['dialogue']:
-            turn_idx = turn['turn_idx']
-            turn_idx_str = str(turn_idx)
-            annotation = list(remove_none_slots(pred_data[dialogue_id][turn_idx_str]['turn_belief']))
-            annotation.sort()
-            prediction = list(remove_none_slots(pred_data[dialogue_id][turn_idx_str]['pred_bs_ptr']))
-            prediction.sort()
-
-            joint_accuracy = get_joint_accuracy(pred_data[dialogue_id][turn_idx_str])
-
-            example = ExampleTuple(dialogue, turn_idx, annotation, prediction,
-                                   previous=previous, label=joint_accuracy, features=dict())
-            examples.append(example)
-            previous = example
+    for i, example in enumerate(examples):
+        examples[i] = previous = example._replace(previous=previous)
 
     return examples
 
 
+def print_example(example):
+    dialogue = example.dialogue
+    print()
+    print(dialogue['dialogue_idx'] + '/' + str(example.turn_idx))
+    for turn_idx in range(example.turn_idx + 1):
+        if turn_idx > 0:
+            print('S: ' + dialogue['dialogue'][turn_idx]['system_transcript'])
+        print('U: ' + dialogue['dialogue'][turn_idx]['transcript'])
+    print('Ann:', example.annotation)
+    print('Pred:', example.prediction)
+
+
 def featurize_examples(examples):
     X = np.zeros((len(examples), 2*len(ALL_FEATURES)), dtype=np.float32)
     Y = np.empty((len(examples),), dtype=np.float32)
@@ -292,7 +303,7 @@ def featurize_examples(examples):
     return X, Y
 
 
-def do_cluster(dialogue_dev_data, pred_data, errors, error_features):
+def do_cluster(dialogue_dev_data, errors, error_features):
     clustering = sklearn.cluster.AffinityPropagation(max_iter=10000, verbose=True)
     clustering.fit(error_features)
     N_CLUSTERS = len(clustering.cluster_centers_)
@@ -325,12 +336,12 @@ def do_cluster(dialogue_dev_data, pred_data, errors, error_features):
                 print(feature, '=', center[feature_idx])
 
         for error in clusters[cluster_idx][:5]:
-            print_turn(dialogue_dev_data, pred_data, error.dialogue['dialogue_idx'], error.turn_idx)
+            print_example(error)
 
         break
 
 
-def do_lda(dialogue_dev_data, pred_data, errors, error_features):
+def do_lda(dialogue_dev_data, errors, error_features):
     N_CLUSTERS = 5
     lda = sklearn.decomposition.LatentDirichletAllocation(n_components=N_CLUSTERS,
                                                           random_state=1234,
@@ -360,10 +371,10 @@ def do_lda(dialogue_dev_data, pred_data, errors, error_features):
             print(feature, '=', topic_assign_prob[cluster_idx, feature_idx])
 
         #for error in clusters[cluster_idx][:5]:
-        #    print_turn(dialogue_dev_data, pred_data, error.dialogue['dialogue_idx'], error.turn_idx)
+        #    print_example(error)
 
 
-def do_classifier(dialogue_dev_data, pred_data, examples, example_features, example_labels):
+def do_classifier(dialogue_dev_data, examples, example_features, example_labels):
     classifier = sklearn.linear_model.LogisticRegression(class_weight='balanced', verbose=1)
 
     classifier.fit(example_features, example_labels)
@@ -376,7 +387,7 @@ def do_classifier(dialogue_dev_data, pred_data, examples, example_features, exam
         print(f'{feature} = {classifier.coef_[0, feature_idx]}')
 
 
-def do_heuristic(dialogue_dev_data, pred_data, examples, example_features, example_labels):
+def do_heuristic(dialogue_dev_data, examples, example_features, example_labels):
     all_features = list(ALL_FEATURES) + ['!' + feature for feature in ALL_FEATURES]
     feature_counts = np.sum(example_features, axis=0)
     feature_error_count = np.zeros((len(all_features),), dtype=np.float32)
@@ -398,7 +409,7 @@ def do_heuristic(dialogue_dev_data, pred_data, examples, example_features, examp
                                            100 * error_pct))
 
 
-def do_greedy(dialogue_dev_data, pred_data, examples):
+def do_greedy(dialogue_dev_data, examples):
     all_features = list(ALL_FEATURES) + ['!' + feature for feature in ALL_FEATURES]
 
     examples_total = len(examples)
@@ -445,11 +456,10 @@ def main():
     #modelname = 'aug5'
 
     dialogue_dev_data = load_data()
-    pred_data_all = load_predictions([modelname])
-    pred_data = pred_data_all[modelname]
+    pred_files = load_predictions([modelname])
     print('loaded data', file=sys.stderr)
 
-    examples = compute_examples(dialogue_dev_data, pred_data)
+    examples = compute_examples(dialogue_dev_data, pred_files[modelname])
     random.shuffle(examples)
     print('computed all examples', file=sys.stderr)
 
@@ -461,11 +471,11 @@ def main():
     print('featurized all examples', file=sys.stderr)
 
     #do_count_features(example_features)
-    #do_cluster(dialogue_dev_data, pred_data, errors, example_features)
-    #do_lda(dialogue_dev_data, pred_data, examples, example_features)
-    #do_classifier(dialogue_dev_data, pred_data, examples, example_features, example_labels)
-    #do_heuristic(dialogue_dev_data, pred_data, examples, example_features, example_labels)
-    do_greedy(dialogue_dev_data, pred_data, examples)
+    #do_cluster(dialogue_dev_data, errors, example_features)
+    #do_lda(dialogue_dev_data, examples, example_features)
+    #do_classifier(dialogue_dev_data, examples, example_features, example_labels)
+    #do_heuristic(dialogue_dev_data, examples, example_features, example_labels)
+    do_greedy(dialogue_dev_data, examples)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,97 @@
+import os
+
+import torch
+
+import myTrain
+from utils.config import args
+from utils.continual import Regularizer, EWC, GEM
+from utils.replay import ReplayBuffer
+
+'''
+python continual_train.py --cl_method=ewc -bsz=8 -dr=0.2 -lr=0.001 -path=${save_path_except_domain} -exceptd=${except_domain}
+'''
+
+def run():
+    """
+    Fine-tunes the model of -path, trained on every domain but -exceptd, on a few dialogues (1%) of that
+    domain with the training loop of myTrain.py and the --cl_method regularizer against forgetting the
+    other domains, then tests the best model on both.
+    """
+    if args['dataset'] == 'multiwoz':
+        from utils.utils_multiWOZ_DST import prepare_data_seq
+    else:
+        print("You need to provide the --dataset information")
+        exit(1)
+    if args['cl_method'] == 'gem' and (args['local_rank'] != -1 or args['gradient_accumulation_steps'] > 1 or args['batch_tokens'] > 0):
+        raise ValueError("--cl_method gem steps on the gradient of each batch, on a single process")
+
+    except_domain = args['except_domain']
+    directory = args['path'].split("/")
+    args['hidden'] = int(directory[2].split('HDD')[1].split('BSZ')[0])
+    BSZ = int(args['batch']) if args['batch'] else int(directory[2].split('BSZ')[1].split('DR')[0])
+    args['batch'] = BSZ
+    args['decoder'] = "TRADE"
+    # the fine-tuned models are saved next to the one they start from, under another name
+    args['addName'] = args['cl_method'].upper() + args['addName']
+
+    # the other domains, the few-shot data of the new one is read below
+    fisher_sample, args['fisher_sample'] = args['fisher_sample'], 0
+    train, dev, test, test_special, lang, SLOTS_LIST, gating_dict, max_word = prepare_data_seq(True, args['task'], False, batch_size=BSZ)
+
+    kwargs = {}
+    if args['replay_budget'] > 0:
+        if not 0 < args['replay_ratio'] < 1:
+            raise ValueError("--replay_ratio should be in (0, 1), got {}".format(args['replay_ratio']))
+        path_replay = os.path.join(args['path'], "replay{}.npz".format(args['replay_budget']))
+        if os.path.isfile(path_replay):
+            replay = ReplayBuffer.load(path_replay, args['seed'])
+        else:
+            replay = ReplayBuffer(args['replay_budget'], SLOTS_LIST[1], args['seed'])
+            replay.add_dataset(train.dataset)
+            replay.save(path_replay)
+        kwargs = dict(replay=replay, replay_ratio=args['replay_ratio'], collate=train.collate_fn,
+                      replay_size=max(1, int(round(BSZ * args['replay_ratio'] / (1 - args['replay_ratio'])))))
+        print("Replay buffer {}: {} examples of {}, {:.2f} MB, {} per batch".format(
+            path_replay, len(replay), replay.seen, replay.nbytes() / 1e6, kwargs['replay_size']))
+
+    if args['cl_method'] == 'ewc':
+        regularizer = EWC(os.path.join(args['path'], "fisher{}".format(fisher_sample)), train, SLOTS_LIST[1],
+                          args['lambda_ewc'], fisher_sample, args['fisher_probes'], args['seed'], **kwargs)
+    elif args['cl_method'] == 'gem':
+        # the episodic memory: 1% of the dialogues of the other domains
+        args["data_ratio"] = 1
+        train_GEM = prepare_data_seq(True, args['task'], False, batch_size=64)[0]
+        print("4 domains train set length used for GEM", len(train_GEM.dataset))
+        regularizer = GEM(train_GEM, SLOTS_LIST[1], args['lambda_ewc'], args['gem_refresh'], **kwargs)
+    else:
+        regularizer = Regularizer(**kwargs)
+
+    args['only_domain'] = except_domain
+    args['except_domain'] = ''
+    args["data_ratio"] = 1
+    train_single, dev_single, test_single, _, _, SLOTS_LIST_single, _, _ = prepare_data_seq(True, args['task'], False, batch_size=BSZ)
+    args['except_domain'] = except_domain
+
+    core = myTrain.run(
+        prepare_data=lambda: (train_single, dev_single, test_single, test_special, lang, SLOTS_LIST_single, gating_dict, max_word),
+        regularizer=regularizer)
+
+    # the best model was written in the background by evaluate(), the checkpoints are on disk once run() returns
+    if core.checkpoints.best:
+        best_dir = core.checkpoints.best[0][1]
+        print("[Info] Loading the best model from {}".format(best_dir))
+        core.encoder.load_state_dict(torch.load(os.path.join(best_dir, 'enc.th'), map_location=core.device))
+        core.decoder.load_state_dict(torch.load(os.path.join(best_dir, 'dec.th'), map_location=core.device))
+    core.eval()
+    device = torch.device(core.device)
+
+    # After Fine tuning...
+    print("[Info] After Fine Tune ...")
+    print("[Info] Test Set on 4 domains...")
+    acc_test_4d = core.evaluate(test_special, 1e7, SLOTS_LIST[2], device)
+    print("[Info] Test Set on 1 domain {} ...".format(except_domain))
+    acc_test = core.evaluate(test_single, 1e7, SLOTS_LIST[3], device)
+    return acc_test_4d, acc_test
+
+if __name__ == '__main__':
+    run()
@@ -6,6 +6,8 @@ import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 import ast
+
+from utils.eval_utils import iter_predictions
 usr = os.path.expanduser('~')
 
     
@@ -34,6 +36,13 @@ def read_json(path):
 
 def json_to_frame(json_object):
     return pd.read_json(json.dumps(json_object)).transpose()
+
+# one row per turn of a TRADE prediction file, .jsonl(.gz) files are read a turn at a time
+# instead of going through the nested {dialogue: {turn: ...}} dict
+def read_predictions_frame(path):
+    rows = ((dialogue, turn, prediction['turn_belief'], prediction['pred_bs_ptr'])
+            for dialogue, turn, prediction in iter_predictions(path))
+    return pd.DataFrame.from_records(rows, columns=['dialogue', 'turn', 'turn_belief', 'pred_bs_ptr'])
     
 def n_conversations(results):
     return len(results.keys())
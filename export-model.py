@@ -0,0 +1,31 @@
+import time
+
+import torch
+
+from utils.config import args
+from serve import load_model
+
+'''
+python3 export-model.py -path=${save_path} --artifact=${save_path}/model.pt
+
+Writes the model of -path, with its vocabularies, slots, gating dict and settings, as one file that
+myTest.py and serve.py load with --artifact.
+'''
+
+def run():
+    artifact = args['artifact']
+    if not artifact:
+        raise ValueError("--artifact should name the file to write")
+    # load_model() reads -path when --artifact is not set
+    args['artifact'] = ''
+    model, _ = load_model(torch.device('cpu'))
+    model.save_artifact(artifact)
+    print("Model artifact written to {}".format(artifact))
+
+    args['artifact'] = artifact
+    start = time.perf_counter()
+    load_model(torch.device('cpu'))
+    print("Loaded back in {:.3f}s".format(time.perf_counter() - start))
+
+if __name__ == '__main__':
+    run()
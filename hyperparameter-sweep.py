@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+from multiprocessing.pool import ThreadPool
+
+'''
+python3 hyperparameter-sweep.py --spec sweep.json --out sweeps/hdd-dr -- -dec=TRADE -le=0 --max_epochs 30 --patience 3
+
+sweep.json, either a grid over the listed values:
+    {"grid": {"hidden": [200, 400], "drop": [0.1, 0.2], "learn": [0.001], "batch": [32], "merge_embed": ["sum", "concat"]}}
+or a random search, each value being a list to choose from or {"uniform": [lo, hi]} / {"loguniform": [lo, hi]}:
+    {"random": {"learn": {"loguniform": [0.0001, 0.01]}, "drop": {"uniform": [0.0, 0.3]}, "batch": [16, 32]}, "trials": 20}
+Keys are the long names of the myTrain.py flags.
+'''
+
+def expand_spec(spec, seed):
+    if 'grid' in spec:
+        names = sorted(spec['grid'].keys())
+        return [dict(zip(names, values)) for values in itertools.product(*[spec['grid'][n] for n in names])]
+    rng = random.Random(seed)
+    trials = []
+    for _ in range(spec['trials']):
+        trial = {}
+        for name, values in sorted(spec['random'].items()):
+            if isinstance(values, list):
+                trial[name] = rng.choice(values)
+            elif 'uniform' in values:
+                trial[name] = rng.uniform(*values['uniform'])
+            elif 'loguniform' in values:
+                lo, hi = values['loguniform']
+                trial[name] = math.exp(rng.uniform(math.log(lo), math.log(hi)))
+            else:
+                raise ValueError("unknown distribution for {}: {}".format(name, values))
+        trials.append(trial)
+    return trials
+
+def trial_flags(trial):
+    return ['--{}={}'.format(name, value) for name, value in sorted(trial.items())]
+
+def read_metrics(log_dir):
+    scores = []
+    path = os.path.join(log_dir, 'metrics.jsonl')
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                if 'dev_acc' in record:
+                    scores.append((record['epoch'], record['dev_acc']))
+    return scores
+
+def run_trial(job):
+    index, trial, opt, train_args, env = job
+    log_dir = os.path.join(opt.out, 'trial{}'.format(index))
+    cmd = [sys.executable, 'myTrain.py'] + train_args + trial_flags(trial) + [
+        '--data_cache', opt.data_cache, '--log_dir', log_dir, '--delete_ok', '1',
+        '-an', '{}T{}'.format(opt.name, index)]
+    print("[trial {}] {}".format(index, ' '.join(cmd)), flush=True)
+    with open(log_dir + '.out', 'w') as out:
+        returncode = subprocess.call(cmd, stdout=out, stderr=subprocess.STDOUT, env=env)
+    scores = read_metrics(log_dir)
+    best = max([acc for _, acc in scores]) if scores else float('nan')
+    print("[trial {}] exit code {}, best dev joint acc {:.4f}".format(index, returncode, best), flush=True)
+    return index, trial, returncode, best, len(scores)
+
+def run():
+    parser = argparse.ArgumentParser(description='Local hyperparameter sweep of myTrain.py')
+    parser.add_argument('--spec', help='JSON file with the grid or random search', required=True)
+    parser.add_argument('--out', help='directory of the trial logs and of results.tsv', required=True)
+    parser.add_argument('--name', help='prefix of the save folders of the trials', default='sweep')
+    parser.add_argument('--threads_per_trial', help='torch/OpenMP threads of each trial', type=int, default=2)
+    parser.add_argument('--parallel', help='number of trials run at the same time, defaults to cores / threads_per_trial', type=int, default=0)
+    parser.add_argument('--data_cache', help='preprocessed data shared by the trials, defaults to <out>/data-cache.pkl', default=None)
+    parser.add_argument('--seed', help='seed of the random search', type=int, default=123)
+    parser.add_argument('train_args', nargs=argparse.REMAINDER, help='-- followed by the flags shared by all the trials')
+    opt = parser.parse_args()
+
+    train_args = opt.train_args[1:] if opt.train_args[:1] == ['--'] else opt.train_args
+    with open(opt.spec) as f:
+        trials = expand_spec(json.load(f), opt.seed)
+    os.makedirs(opt.out, exist_ok=True)
+    if opt.data_cache is None:
+        opt.data_cache = os.path.join(opt.out, 'data-cache.pkl')
+    parallel = opt.parallel if opt.parallel else max(1, (os.cpu_count() or 1) // opt.threads_per_trial)
+
+    env = dict(os.environ)
+    env['OMP_NUM_THREADS'] = env['MKL_NUM_THREADS'] = str(opt.threads_per_trial)
+
+    # parse the data once, every trial then loads the same cache
+    first = trial_flags(trials[0])
+    subprocess.check_call([sys.executable, 'myTrain.py'] + train_args + first + [
+        '--data_cache', opt.data_cache, '--preprocess_only', '1', '-an', '{}T0'.format(opt.name)], env=env)
+
+    print("Running {} trials, {} at a time".format(len(trials), parallel))
+    jobs = [(i, trial, opt, train_args, env) for i, trial in enumerate(trials)]
+    pool = ThreadPool(parallel)
+    results = pool.map(run_trial, jobs, chunksize=1)
+    pool.close()
+
+    names = sorted(set(k for trial in trials for k in trial))
+    results.sort(key=lambda r: -r[3] if r[3] == r[3] else float('inf'))
+    with open(os.path.join(opt.out, 'results.tsv'), 'w') as f:
+        header = ['trial'] + names + ['dev_joint_acc', 'evaluations', 'exit_code']
+        f.write('\t'.join(header) + '\n')
+        print('\t'.join(header))
+        for index, trial, returncode, best, evaluations in results:
+            row = [str(index)] + [str(trial.get(n, '')) for n in names] + ['{:.4f}'.format(best), str(evaluations), str(returncode)]
+            f.write('\t'.join(row) + '\n')
+            print('\t'.join(row))
+
+if __name__ == '__main__':
+    run()
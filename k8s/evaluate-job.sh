@@ -18,19 +18,22 @@ ls -d save/TRADE*/ || ln -s . save/TRADE
 # note: myTest is very, very broken, and assumes a very specific directory layout inside save/
 best_model=$(ls -d save/TRADE*/HDD*BSZ* | sort -r | head -n1)
 
-echo "Everything" > results
-python3 myTest.py -gs=1 -path "$best_model" "$@" | tee -a results
-for pred_file in prediction_*; do
-  aws s3 cp ${pred_file} s3://almond-research/${owner}/models/${experiment}/${model}/predictions/full/
-done
-
+# decode the test set once, the metrics and predictions by domain, turn and number of slots are slices of it
+python3 myTest.py -gs=1 -path "$best_model" --eval_slices 1 "$@" | tee results
 for d in hotel train restaurant attraction taxi ; do
-  echo "Only" $d >> results
-  python3 myTest.py -gs=1 -path "$best_model" -onlyd "$d" "$@" | tee -a results
-  for pred_file in prediction_*; do
-    aws s3 cp ${pred_file} s3://almond-research/${owner}/models/${experiment}/${model}/predictions/${d}/
+  for pred_file in prediction_*_only_${d}.json*; do
+    test -f "${pred_file}" || continue
+    aws s3 cp ${pred_file} s3://almond-research/${owner}/models/${experiment}/${model}/predictions/${d}/${pred_file/_only_${d}/}
+    rm ${pred_file}
   done
-
+done
+for pred_file in prediction_*_turn_*.json* prediction_*_slots_*.json*; do
+  test -f "${pred_file}" || continue
+  aws s3 cp ${pred_file} s3://almond-research/${owner}/models/${experiment}/${model}/predictions/slices/
+  rm ${pred_file}
+done
+for pred_file in prediction_*; do
+  aws s3 cp ${pred_file} s3://almond-research/${owner}/models/${experiment}/${model}/predictions/full/
 done
 
 aws s3 cp results s3://almond-research/${owner}/models/${experiment}/${model}/results
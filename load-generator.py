@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import argparse
+import http.client
+import json
+import socket
+import threading
+import time
+
+import numpy as np
+
+'''
+python3 load-generator.py --data data/test_dials.json --clients 32 --dialogues 200 [--socket /tmp/trade.sock]
+
+Replays the dialogues of a data file against serve.py, one session per dialogue and one turn per request,
+from --clients concurrent clients, then prints the client-side latencies and the server /stats.
+'''
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super(UnixHTTPConnection, self).__init__("localhost")
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.unix_path)
+
+
+def connect(args):
+    if args.socket:
+        return UnixHTTPConnection(args.socket)
+    return http.client.HTTPConnection(args.host, args.port)
+
+
+def call(connection, method, path, body=None):
+    connection.request(method, path, body=json.dumps(body) if body is not None else None,
+                       headers={"Content-Type": "application/json"})
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+def client(args, dialogues, latencies, errors):
+    connection = connect(args)
+    for dialogue in dialogues:
+        session = "{}-{}".format(dialogue["dialogue_idx"], threading.get_ident())
+        for turn in sorted(dialogue["dialogue"], key=lambda turn: int(turn["turn_idx"])):
+            start = time.perf_counter()
+            status, _ = call(connection, "POST", "/track",
+                             {"session": session, "system": turn["system_transcript"], "user": turn["transcript"]})
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                errors.append(status)
+        call(connection, "POST", "/track", {"session": session, "end": True})
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load generator for serve.py')
+    parser.add_argument('--data', help='dialogues to replay', default='data/test_dials.json', type=str)
+    parser.add_argument('--dialogues', help='number of dialogues replayed, 0 for all', default=0, type=int)
+    parser.add_argument('--clients', help='number of concurrent clients', default=16, type=int)
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--socket', help='unix socket of the server, instead of --host and --port', default='', type=str)
+    args = parser.parse_args()
+
+    with open(args.data) as f:
+        dialogues = json.load(f)
+    if args.dialogues > 0:
+        # cycle through the file to get the requested number of dialogues
+        dialogues = [dialogues[i % len(dialogues)] for i in range(args.dialogues)]
+
+    latencies, errors = [], []
+    threads = [threading.Thread(target=client, args=(args, dialogues[c::args.clients], latencies, errors))
+               for c in range(args.clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1000
+    print("{} requests from {} clients in {:.1f}s: {:.1f} requests/s, {} errors".format(
+        len(latencies), args.clients, elapsed, len(latencies) / elapsed, len(errors)))
+    if len(latencies):
+        print("client latency ms: p50 {:.1f} p95 {:.1f} p99 {:.1f}".format(*np.percentile(latencies, [50, 95, 99])))
+    connection = connect(args)
+    print("server stats:", json.dumps(call(connection, "GET", "/stats")[1], indent=2))
+    connection.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+
+import resource
+import time
+
+from utils.config import args
+from models.TRADE import BERTEncoder
+
+'''
+for n in 2 4 6 12 ; do python3 measure-bert-encoder.py --encoder BERT --bert_model bert-base-uncased --num_bert_layers $n ; done
+'''
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def run():
+    rss_before = peak_rss_mb()
+    start = time.time()
+    encoder = BERTEncoder(int(args['hidden']), 0.0, 'cpu')
+    elapsed = time.time() - start
+    print("layers={} construction_time={:.2f}s peak_rss={:.0f}MB (before construction {:.0f}MB)".format(
+        len(encoder.bert.encoder.layer), elapsed, peak_rss_mb(), rss_before))
+
+if __name__ == '__main__':
+    run()
@@ -3,21 +3,34 @@ from torch import optim
 import torch.nn.functional as F
 import random
 import json
+import weakref
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 import os
 import numpy as np
 
-from utils.masked_cross_entropy import masked_cross_entropy_for_value
-from utils.config import args, PAD_token
+from utils.masked_cross_entropy import masked_cross_entropy_for_value, soft_cross_entropy_for_value, soft_cross_entropy_for_gate
+from utils.config import args, parser, PAD_token, UNK_token, EOS_token
+from utils.utils_multiWOZ_DST import batch_to_device, EXPERIMENT_DOMAINS, Lang
+from utils.checkpoint import CheckpointManager, atomic_save, cpu_snapshot
+from utils.logger import PhaseTimer
+from utils.eval_utils import PredictionWriter, BeliefMetrics, save_predictions
+from utils.sharded_eval import predict_sharded
 from models.modules import TPRencoder_LSTM
 
-from transformers.modeling_bert import BertModel
-from transformers.file_utils import PYTORCH_PRETRAINED_BERT_CACHE
+from transformers.modeling_bert import BertModel, BertConfig, BERT_PRETRAINED_MODEL_ARCHIVE_MAP
+from transformers.file_utils import PYTORCH_PRETRAINED_BERT_CACHE, WEIGHTS_NAME, cached_path
 from transformers.optimization import AdamW, WarmupLinearSchedule
 
+# the settings a model artifact is built and run with
+ARTIFACT_ARGS = ['encoder', 'cell_type', 'nSymbols', 'nRoles', 'dSymbols', 'dRoles', 'temperature', 'scale_val', 'train_scale',
+                 'merge_embed', 'pretrain_domain_embeddings', 'bert_model', 'num_bert_layers', 'do_lower_case',
+                 'use_gate', 'carryover_belief', 'context_window', 'max_context_length']
+
 class TRADE(nn.Module):
-    def __init__(self, hidden_size, lang, path, task, lr, dropout, slots, gating_dict, t_total, device, nb_train_vocab=0):
+    def __init__(self, hidden_size, lang, path, task, lr, dropout, slots, gating_dict, t_total, device, nb_train_vocab=0, encoder_type=None,
+                 load_pretrained=True, bert_config=None):
         super(TRADE, self).__init__()
         self.name = "TRADE"
         self.task = task
@@ -33,17 +46,19 @@ class TRADE(nn.Module):
         self.nb_gate = len(gating_dict)
         self.cross_entorpy = nn.CrossEntropyLoss()
         self.cell_type = args['cell_type']
+        # the encoder type can differ from args['encoder'] for the teacher model used in distillation
+        self.encoder_type = encoder_type if encoder_type else args['encoder']
 
-        if args['encoder'] == 'RNN':
+        if self.encoder_type == 'RNN':
             self.encoder = EncoderRNN(self.lang.n_words, hidden_size, self.dropout, self.device, self.cell_type)
             self.decoder = Generator(self.lang, self.encoder.embedding, self.lang.n_words, hidden_size, self.dropout, self.slots, self.nb_gate, self.device, self.cell_type)
-        elif args['encoder'] == 'TPRNN':
+        elif self.encoder_type == 'TPRNN':
             self.encoder = EncoderTPRNN(self.lang.n_words, hidden_size, self.dropout, self.device, self.cell_type,
                                         args['nSymbols'], args['nRoles'], args['dSymbols'], args['dRoles'],
                                         args['temperature'], args['scale_val'], args['train_scale'])
             self.decoder = Generator(self.lang, self.encoder.embedding, self.lang.n_words, hidden_size, self.dropout, self.slots, self.nb_gate, self.device, self.cell_type)
         else:
-            self.encoder = BERTEncoder(hidden_size, self.dropout, self.device)
+            self.encoder = BERTEncoder(hidden_size, self.dropout, self.device, load_pretrained, bert_config)
             self.decoder = Generator(self.lang, None, self.lang.n_words, hidden_size, self.dropout, self.slots, self.nb_gate, self.device, self.cell_type)
 
         if path:
@@ -51,8 +66,14 @@ class TRADE(nn.Module):
             trained_encoder = torch.load(str(path)+'/enc.th', map_location=self.device)
             trained_decoder = torch.load(str(path)+'/dec.th', map_location=self.device)
 
+            # older models were saved as whole modules, newer ones as state dicts
+            if isinstance(trained_encoder, nn.Module):
+                trained_encoder = trained_encoder.state_dict()
+            if isinstance(trained_decoder, nn.Module):
+                trained_decoder = trained_decoder.state_dict()
+
             # fix small confusion between old and newer trained models
-            encoder_dict = trained_encoder.state_dict()
+            encoder_dict = trained_encoder
             new_encoder_dict = {}
             for key in encoder_dict:
                 mapped_key = key
@@ -60,7 +81,7 @@ class TRADE(nn.Module):
                     mapped_key = 'rnn.' + key[len('gru.'):]
                 new_encoder_dict[mapped_key] = encoder_dict[key]
 
-            decoder_dict = trained_decoder.state_dict()
+            decoder_dict = trained_decoder
             new_decoder_dict = {}
             for key in decoder_dict:
                 mapped_key = key
@@ -77,13 +98,10 @@ class TRADE(nn.Module):
 
 
         # Initialize optimizers and criterion
-        if args['encoder'] == 'RNN':
+        if self.encoder_type == 'RNN':
             self.optimizer = optim.Adam(self.parameters(), lr=lr)
             self.scheduler = lr_scheduler.ReduceLROnPlateau(self.optimizer, mode='max', factor=0.5, patience=1, min_lr=0.0001, verbose=True)
         else:
-            if args['local_rank'] != -1:
-                t_total = t_total // torch.distributed.get_world_size()
-
             no_decay = ['bias', 'LayerNorm.bias', 'LayerNorm.weight']
             optimizer_grouped_parameters = [
                 {'params': [p for n, p in self.named_parameters() if not any(nd in n for nd in no_decay)], 'weight_decay': 0.01},
@@ -92,6 +110,15 @@ class TRADE(nn.Module):
             self.optimizer = AdamW(optimizer_grouped_parameters, lr=args['learn'], correct_bias=False)
             self.scheduler = WarmupLinearSchedule(self.optimizer, warmup_steps=args['warmup_proportion'] * t_total, t_total=t_total)
 
+        self.checkpoints = CheckpointManager(keep_best=args['keep_best'])
+        # replaced by an enabled timer by myTrain.py when --metrics_every is set
+        self.timer = PhaseTimer(enabled=False)
+        self.decode_rows = None
+        self.no_value_rows = False
+        # the per-batch random masks are drawn on the device, from a generator of their own
+        rank = torch.distributed.get_rank() if torch.distributed.is_available() and torch.distributed.is_initialized() else 0
+        self.noise = torch.Generator(device=self.device)
+        self.noise.manual_seed(args['seed'] + rank)
         self.reset()
 
     def print_loss(self):    
@@ -103,29 +130,92 @@ class TRADE(nn.Module):
         self.print_every += 1     
         return 'L:{:.2f},LP:{:.2f},LG:{:.2f}'.format(print_loss_avg,print_loss_ptr,print_loss_gate)
     
-    def save_model(self, dec_type):
+    def save_model(self, dec_type, score=None, state=None):
         directory = 'save/TRADE-'+args["addName"]+args['dataset']+str(self.task)+'/'+'HDD'+str(self.hidden_size)+'BSZ'+str(args['batch'])+'DR'+str(self.dropout)+str(dec_type)                 
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        torch.save(self.encoder, directory + '/enc.th')
-        torch.save(self.decoder, directory + '/dec.th')
+        # state: snapshot of earlier weights ({'encoder': ..., 'decoder': ...}) to save instead of the current ones
+        if state is None:
+            state = {'encoder': self.encoder.state_dict(), 'decoder': self.decoder.state_dict()}
+        # written in the background, the best --keep_best scored models are kept
+        self.checkpoints.save(directory, {'enc.th': state['encoder'], 'dec.th': state['decoder']}, score=score)
+        return directory
     
+    def save_artifact(self, path):
+        """
+        Writes the model for inference as one file, read by load_artifact(): the weights, the vocabularies,
+        the slots, the gating dict, the ARTIFACT_ARGS settings and the BERT config.
+        """
+        artifact = {
+            'format': 'TRADE',
+            'version': 1,
+            'hidden_size': self.hidden_size,
+            'task': self.task,
+            'args': dict((k, args[k]) for k in ARTIFACT_ARGS),
+            'lang': [self.lang.index2word[i] for i in range(self.lang.n_words)],
+            'mem_lang': [self.mem_lang.index2word[i] for i in range(self.mem_lang.n_words)],
+            'slots': list(self.slots),
+            'slot_temp': list(self.slot_temp),
+            'gating_dict': dict(self.gating_dict),
+            'encoder': cpu_snapshot(self.encoder.state_dict()),
+            'decoder': cpu_snapshot(self.decoder.state_dict()),
+        }
+        if self.encoder_type == 'BERT':
+            # the artifact is built without reading the config of -bert_model
+            artifact['bert_config'] = self.encoder.bert.config.to_dict()
+        # read from the embedding file, not a parameter
+        if isinstance(getattr(self.decoder, 'domain_emb', None), torch.Tensor):
+            artifact['domain_emb'] = self.decoder.domain_emb.detach().cpu()
+        atomic_save(artifact, path)
+
     def reset(self):
         self.loss, self.print_every, self.loss_ptr, self.loss_gate, self.loss_class = 0, 1, 0, 0, 0
 
     def forward(self, data, clip, slot_temp, reset=0, n_gpu=0):
         if reset: self.reset()
-        # Zero gradients of both optimizers
-        self.optimizer.zero_grad()
+        # gradients are zeroed by the caller after each optimizer step, so they can be accumulated
+        loss = self.training_loss(data, slot_temp)
+
+        self.loss_grad = loss
         
+        # Update parameters with optimizers
+        self.loss += loss.item()
+        self.loss_ptr += self.loss_ptr_to_bp.item()
+        self.loss_gate += self.loss_gate_to_bp.item()
+
+        return self.loss_grad
+
+    def training_loss(self, data, slot_temp):
+        """
+        Loss of the batch `data` as forward() computes it, without adding it to the running losses that
+        the training loop reports: also for the extra batches of the continual learning regularizers.
+        """
         # Encode and Decode
         use_teacher_forcing = random.random() < args["teacher_forcing_ratio"]
-        all_point_outputs, gates, words_point_out, words_class_out = self.encode_and_decode(data, use_teacher_forcing, slot_temp)
-
-        loss_ptr = masked_cross_entropy_for_value(
-            all_point_outputs.transpose(0, 1).contiguous(),
-            data["generate_y"].contiguous(), #[:,:len(self.point_slots)].contiguous(),
-            data["y_lengths"]) #[:,:len(self.point_slots)])
+        all_point_outputs, gates, point_ids, words_class_out = self.encode_and_decode(data, use_teacher_forcing, slot_temp)
+
+        with self.timer.phase('loss'):
+            return self.compute_loss(data, all_point_outputs, gates)
+
+    def compute_loss(self, data, all_point_outputs, gates):
+        y_lengths = data["y_lengths"]
+        if "carry" in self.gating_dict:
+            # carried-over slots are copied from the previous belief state, no value to generate
+            y_lengths = y_lengths * (data["gating_label"] != self.gating_dict["carry"]).long()
+        value_outputs = all_point_outputs.transpose(0, 1).contiguous()
+        generate_y = data["generate_y"]
+        if self.decode_rows is not None:
+            # only the sampled rows were decoded: one "slot" per row, b * 1 * m * |v|
+            value_outputs = all_point_outputs.unsqueeze(1)
+            y_lengths = self.select_rows(y_lengths)
+            generate_y = self.select_rows(generate_y)
+        # no value to generate in the batch: the masked means would divide by zero
+        no_values = self.decode_rows is not None and self.no_value_rows
+        if no_values:
+            loss_ptr = value_outputs.sum() * 0.0
+        else:
+            loss_ptr = masked_cross_entropy_for_value(
+                value_outputs,
+                generate_y.contiguous(), #[:,:len(self.point_slots)].contiguous(),
+                y_lengths) #[:,:len(self.point_slots)])
         loss_gate = self.cross_entorpy(gates.transpose(0, 1).contiguous().view(-1, gates.size(-1)), data["gating_label"].contiguous().view(-1))
 
         if args["use_gate"]:
@@ -133,16 +223,42 @@ class TRADE(nn.Module):
         else:
             loss = loss_ptr
 
-        self.loss_grad = loss
+        if "teacher_gate" in data:
+            # distillation: mix the gold labels with the soft targets of the teacher
+            temperature = args["distill_temperature"]
+            if no_values:
+                loss_soft = value_outputs.sum() * 0.0
+            else:
+                loss_soft = soft_cross_entropy_for_value(
+                    value_outputs,
+                    self.select_rows(data["teacher_value_prob"]) if self.decode_rows is not None else data["teacher_value_prob"],
+                    self.select_rows(data["teacher_value_idx"]) if self.decode_rows is not None else data["teacher_value_idx"],
+                    y_lengths,
+                    temperature)
+            if args["use_gate"]:
+                loss_soft = loss_soft + soft_cross_entropy_for_gate(gates.transpose(0, 1), data["teacher_gate"], temperature)
+            loss = (1 - args["distill_alpha"]) * loss + args["distill_alpha"] * loss_soft
+
         self.loss_ptr_to_bp = loss_ptr
-        
-        # Update parameters with optimizers
-        self.loss += loss.item()
-        self.loss_ptr += loss_ptr.item()
-        self.loss_gate += loss_gate.item()
+        self.loss_gate_to_bp = loss_gate
+        return loss
 
-        return self.loss_grad
+    def select_rows(self, x):
+        """Decoded rows of a batch-first tensor (b * |s| * ...), as b' * 1 * ..."""
+        x = x.transpose(0, 1).reshape(-1, *x.size()[2:])
+        return x[self.decode_rows].unsqueeze(1)
 
+    def soft_targets(self, data, slot_temp, topk):
+        """
+        Outputs used as soft targets when distilling this model: the gate logits and the top-k
+        value probabilities of every decoding step, teacher-forced on the gold values.
+        """
+        self.encoder.train(False)
+        self.decoder.train(False)
+        with torch.no_grad():
+            all_point_outputs, gates, _, _ = self.encode_and_decode(data, True, slot_temp)
+            value_prob, value_idx = all_point_outputs.topk(topk, dim=-1)
+        return gates.transpose(0, 1), value_prob.transpose(0, 1), value_idx.transpose(0, 1)
 
     def optimize_GEM(self, clip):
         torch.nn.utils.clip_grad_norm_(self.parameters(), clip)
@@ -151,26 +267,25 @@ class TRADE(nn.Module):
             self.scheduler.step()
 
     def encode_and_decode(self, data, use_teacher_forcing, slot_temp):
-        if args['encoder'] == 'RNN' or args['encoder'] == 'TPRNN':
+        if self.encoder_type == 'RNN' or self.encoder_type == 'TPRNN':
             # Build unknown mask for memory to encourage generalization
             if args['unk_mask'] and self.decoder.training:
-                story_size = data['context'].size()
-                rand_mask = np.ones(story_size)
-                bi_mask = np.random.binomial([np.ones((story_size[0], story_size[1]))], 1-self.dropout)[0]
-                rand_mask = rand_mask * bi_mask
-                rand_mask = torch.Tensor(rand_mask).to(self.device)
-                story = data['context'] * rand_mask.long()
+                # each word is replaced by UNK with probability dropout
+                context = data['context']
+                keep = torch.rand(context.size(), device=context.device, generator=self.noise_on(context.device)) < 1 - self.dropout
+                story = context.masked_fill(~keep, UNK_token)
             else:
                 story = data['context']
 
             story = story.to(self.device)
             # encoded_outputs, encoded_hidden = self.encoder(story.transpose(0, 1), data['context_len'])
-            encoded_outputs, encoded_hidden = self.encoder(story, data['context_len'])
+            with self.timer.phase('encoder'):
+                encoded_outputs, encoded_hidden = self.encoder(story, data['context_len'])
 
         # Encode dialog history
         # story  32 396
         # data['context_len'] 32
-        elif args['encoder'] == 'BERT':
+        elif self.encoder_type == 'BERT':
             # import pdb; pdb.set_trace()
             story = data['context']
             # story_plain = data['context_plain']
@@ -180,100 +295,135 @@ class TRADE(nn.Module):
             all_segment_ids = data['all_segment_ids']
             all_sub_word_masks = data['all_sub_word_masks']
 
-            encoded_outputs, encoded_hidden = self.encoder(all_input_ids, all_input_mask, all_segment_ids, all_sub_word_masks)
+            with self.timer.phase('encoder'):
+                encoded_outputs, encoded_hidden = self.encoder(all_input_ids, all_input_mask, all_segment_ids, all_sub_word_masks)
             encoded_hidden = encoded_hidden.unsqueeze(0)
 
         # Get the words that can be copied from the memory
         # import pdb; pdb.set_trace()
         batch_size = len(data['context_len'])
         self.copy_list = data['context_plain']
-        max_res_len = data['generate_y'].size(2) if self.encoder.training else 10
+        max_res_len = data['generate_y'].size(2) if self.encoder.training or use_teacher_forcing else 10
 
-        all_point_outputs, all_gate_outputs, words_point_out, words_class_out = self.decoder.forward(batch_size, \
-            encoded_hidden, encoded_outputs, data['context_len'], story, max_res_len, data['generate_y'], \
-            use_teacher_forcing, slot_temp)
+        # training with --none_slot_ratio: only decode the slots with a value and a sample of the "none" ones
+        self.decode_rows = None
+        if self.decoder.training and args['none_slot_ratio'] >= 0 and args['parallel_decode']:
+            self.decode_rows = self.sample_decode_rows(data['gating_label'])
 
-        return all_point_outputs, all_gate_outputs, words_point_out, words_class_out
+        with self.timer.phase('decoder'):
+            all_point_outputs, all_gate_outputs, point_ids, words_class_out = self.decoder.forward(batch_size, \
+                encoded_hidden, encoded_outputs, data['context_len'], story, max_res_len, data['generate_y'], \
+                use_teacher_forcing, slot_temp, decode_rows=self.decode_rows)
 
-    def evaluate(self, dev, matric_best, slot_temp, device, save_dir="", save_string = "", early_stop=None):
-        # Set to not-training mode to disable dropout
-        self.encoder.train(False)
-        self.decoder.train(False)  
-        print("STARTING EVALUATION")
+        return all_point_outputs, all_gate_outputs, point_ids, words_class_out
+
+    def noise_on(self, device):
+        """self.noise, or None (the default generator) on the other GPUs of DataParallel."""
+        return self.noise if self.noise.device == torch.device(device) else None
+
+    def sample_decode_rows(self, gating_label):
+        """
+        Rows (slot-major, row = slot * batch_size + example) decoded during training: every slot whose
+        value has to be generated, plus each "none" slot with probability --none_slot_ratio.
+        """
+        gating = gating_label.transpose(0, 1).reshape(-1)
+        carry = gating == self.gating_dict.get("carry", -1)
+        skip = carry | (gating == self.gating_dict["none"])
+        keep = ~skip | (torch.rand(gating.size(), device=gating.device, generator=self.noise_on(gating.device)) < args['none_slot_ratio'])
+        rows = keep.nonzero().squeeze(1)
+        self.no_value_rows = False
+        if rows.numel() == 0:
+            # the decoder needs a row: one with a value, a carried slot has a zero target length
+            rows = (~carry).nonzero().squeeze(1)[:1]
+            if rows.numel() == 0:
+                # every slot is carried, compute_loss() skips the value loss
+                rows = torch.zeros(1, dtype=torch.long, device=gating.device)
+                self.no_value_rows = True
+        return rows
+
+    def predict(self, dev, slot_temp, device, writer=None, metrics=None, keep=True):
+        """
+        The {dialogue: {turn: {"turn_belief": gold, "pred_bs_ptr": predicted}}} beliefs of the examples of
+        `dev`, each also written to the PredictionWriter `writer` and added to the BeliefMetrics `metrics`
+        as it is decoded. With keep=False they are not kept, and the dict is empty.
+        """
         all_prediction = {}
-        inverse_unpoint_slot = dict([(v, k) for k, v in self.gating_dict.items()])
+        carryover = getattr(dev.dataset, "carryover", False)
+        if carryover:
+            dev.dataset.predicted_belief = {}
+        self.value_cache = {}
         pbar = enumerate(dev)
         for j, data_dev in pbar: 
             # Encode and Decode
-            eval_data = {}
-            # wrap all numerical values as tensors for multi-gpu training
-            for k, v in data_dev.items():
-                if isinstance(v, torch.Tensor):
-                    eval_data[k] = v.to(device)
-                elif isinstance(v, list):
-                    if k in ['ID', 'turn_belief', 'context_plain', 'turn_uttr_plain']:
-                        eval_data[k] = v
-                    else:
-                        eval_data[k] = torch.tensor(v).to(device)
-                else:
-                    # print('v is: {} and this ignoring {}'.format(v, k))
-                    pass
+            eval_data = batch_to_device(data_dev, device)
             batch_size = len(data_dev['context_len'])
             with torch.no_grad():
-                _, gates, words, class_words = self.encode_and_decode(eval_data, False, slot_temp)
+                _, gates, point_ids, _ = self.encode_and_decode(eval_data, False, slot_temp)
 
+            prev_beliefs = data_dev["prev_belief"] if "carry" in self.gating_dict else None
+            beliefs = self.predict_beliefs(gates, point_ids, slot_temp, prev_beliefs)
             for bi in range(batch_size):
-                if data_dev["ID"][bi] not in all_prediction.keys():
-                    all_prediction[data_dev["ID"][bi]] = {}
-                all_prediction[data_dev["ID"][bi]][data_dev["turn_id"][bi]] = {"turn_belief":data_dev["turn_belief"][bi]}
-                predict_belief_bsz_ptr, predict_belief_bsz_class = [], []
-                gate = torch.argmax(gates.transpose(0, 1)[bi], dim=1)
-                # import pdb; pdb.set_trace()
-
-                # pointer-generator results
-                if args["use_gate"]:
-                    for si, sg in enumerate(gate):
-                        if sg==self.gating_dict["none"]:
-                            continue
-                        elif sg==self.gating_dict["ptr"]:
-                            pred = np.transpose(words[si])[bi]
-                            st = []
-                            for e in pred:
-                                if e== 'EOS': break
-                                else: st.append(e)
-                            st = " ".join(st)
-                            if st == "none":
-                                continue
-                            else:
-                                predict_belief_bsz_ptr.append(slot_temp[si]+"-"+str(st))
-                        else:
-                            predict_belief_bsz_ptr.append(slot_temp[si]+"-"+inverse_unpoint_slot[sg.item()])
-                else:
-                    for si, _ in enumerate(gate):
-                        pred = np.transpose(words[si])[bi]
-                        st = []
-                        for e in pred:
-                            if e == 'EOS': break
-                            else: st.append(e)
-                        st = " ".join(st)
-                        if st == "none":
-                            continue
-                        else:
-                            predict_belief_bsz_ptr.append(slot_temp[si]+"-"+str(st))
-
-                all_prediction[data_dev["ID"][bi]][data_dev["turn_id"][bi]]["pred_bs_ptr"] = predict_belief_bsz_ptr
+                predict_belief_bsz_ptr = beliefs[bi]
+                prediction = {"turn_belief":data_dev["turn_belief"][bi], "pred_bs_ptr":predict_belief_bsz_ptr}
+                if keep:
+                    all_prediction.setdefault(data_dev["ID"][bi], {})[data_dev["turn_id"][bi]] = prediction
+                if carryover:
+                    dev.dataset.predicted_belief[(data_dev["ID"][bi], data_dev["turn_id"][bi])] = predict_belief_bsz_ptr
+                if writer is not None:
+                    writer.write(data_dev["ID"][bi], data_dev["turn_id"][bi], prediction)
+                if metrics is not None:
+                    metrics.add(data_dev["ID"][bi], prediction)
 
                 #if set(data_dev["turn_belief"][bi]) != set(predict_belief_bsz_ptr) and args["genSample"]:
                 #    print("True", set(data_dev["turn_belief"][bi]) )
                 #    print("Pred", set(predict_belief_bsz_ptr), "\n")
+        # the evaluation-sized buffers are not kept for training
+        self.decoder.release_workspace()
+        return all_prediction
+
+    def evaluate(self, dev, matric_best, slot_temp, device, save_dir="", save_string = "", early_stop=None, keep_predictions=False):
+        """
+        The metrics are accumulated as the turns are decoded: the predictions are only kept, in
+        self.last_prediction, with keep_predictions or to save them as one .json file.
+        self.last_metrics is the BeliefMetrics of the evaluation.
+        """
+        # Set to not-training mode to disable dropout
+        self.encoder.train(False)
+        self.decoder.train(False)  
+        print("STARTING EVALUATION")
+        # with --prediction_format jsonl(.gz), the predictions are written as they are decoded
+        writer = None
+        if args["genSample"] and args["prediction_format"] != "json":
+            if save_dir != "" and not os.path.exists(save_dir):
+                os.mkdir(save_dir)
+            writer = PredictionWriter(os.path.join(save_dir, "prediction_{}_{}.{}".format(self.name, save_string, args["prediction_format"])))
+        keep = keep_predictions or (args["genSample"] and writer is None)
+        metrics = BeliefMetrics(self, slot_temp)
+        if args["eval_workers"] > 1 and str(device) == "cpu":
+            # the workers send their predictions back: the merged ones are in memory until scored
+            all_prediction = predict_sharded(self, dev, slot_temp, args["eval_workers"])
+            for dialogue, turns in all_prediction.items():
+                for turn, prediction in turns.items():
+                    if writer is not None:
+                        writer.write(dialogue, turn, prediction)
+                    metrics.add(dialogue, prediction)
+            if not keep:
+                all_prediction = {}
+        else:
+            all_prediction = self.predict(dev, slot_temp, device, writer, metrics, keep)
 
-        if args["genSample"]:
+        if writer is not None:
+            writer.close()
+            print("saved generated samples", writer.path)
+        elif args["genSample"]:
             if save_dir is not "" and not os.path.exists(save_dir):
                 os.mkdir(save_dir)
             json.dump(all_prediction, open(os.path.join(save_dir, "prediction_{}_{}.json".format(self.name, save_string)), 'w'), indent=4)
             print("saved generated samples", os.path.join(save_dir, "prediction_{}_{}.json".format(self.name, save_string)))
 
-        joint_acc_score_ptr, F1_score_ptr, turn_acc_score_ptr = self.evaluate_metrics(all_prediction, "pred_bs_ptr", slot_temp)
+        joint_acc_score_ptr, F1_score_ptr, turn_acc_score_ptr = metrics.scores()
+        self.last_metrics = metrics
+        self.last_prediction = all_prediction if keep else None
 
         evaluation_metrics = {"Joint Acc":joint_acc_score_ptr, "Turn Acc":turn_acc_score_ptr, "Joint F1":F1_score_ptr}
         print(evaluation_metrics)
@@ -287,37 +437,106 @@ class TRADE(nn.Module):
 
         if (early_stop == 'F1'):
             if (F1_score >= matric_best):
-                self.save_model('ENTF1-{:.4f}'.format(F1_score))
+                self.save_model('ENTF1-{:.4f}'.format(F1_score), score=F1_score)
                 print("MODEL SAVED")  
             return F1_score
         else:
             if (joint_acc_score >= matric_best):
-                self.save_model('ACC-{:.4f}'.format(joint_acc_score))
+                self.save_model('ACC-{:.4f}'.format(joint_acc_score), score=joint_acc_score)
                 print("MODEL SAVED")
             return joint_acc_score
 
+    def predict_beliefs(self, gates, point_ids, slot_temp, prev_beliefs=None):
+        """
+        The predicted belief state ("slot-value" strings) of each example of a batch, from the gate logits
+        |slot| * batch * gates and the decoded word ids |slot| * batch * max_res_len. The gates and the
+        lengths of the values (up to the first EOS) are computed on the whole batch, then each value is
+        looked up once in self.value_cache. prev_beliefs are the previous turn's beliefs, for the carry gate.
+        """
+        is_eos = point_ids == EOS_token
+        lengths = torch.where(is_eos.any(-1), is_eos.int().argmax(-1), torch.full_like(point_ids[..., 0], point_ids.size(-1)))
+        if args["use_gate"]:
+            gates = gates.argmax(-1).transpose(0, 1).tolist()
+        ids, lengths = point_ids.transpose(0, 1).tolist(), lengths.transpose(0, 1).tolist()
+        none, ptr, carry = self.gating_dict["none"], self.gating_dict["ptr"], self.gating_dict.get("carry")
+        inverse_unpoint_slot = dict([(v, k) for k, v in self.gating_dict.items()])
+        index2word = self.lang.index2word
+        cache = getattr(self, "value_cache", {})
+        beliefs = []
+        for bi in range(len(ids)):
+            belief = []
+            for si, slot in enumerate(slot_temp):
+                sg = gates[bi][si] if args["use_gate"] else ptr
+                if sg == none:
+                    continue
+                elif sg == ptr:
+                    value = tuple(ids[bi][si][:lengths[bi][si]])
+                    st = cache.get(value)
+                    if st is None:
+                        st = cache[value] = " ".join(index2word[w] for w in value)
+                    if st != "none":
+                        belief.append(slot + "-" + st)
+                elif sg == carry:
+                    # keep the value predicted at the previous turn, if any
+                    belief += [b for b in prev_beliefs[bi] if b.startswith(slot + "-")]
+                else:
+                    belief.append(slot + "-" + inverse_unpoint_slot[sg])
+            beliefs.append(belief)
+        return beliefs
+
+    def evaluate_slices(self, all_prediction, dialogue_domains, slot_temp, save_dir="", save_string=""):
+        """
+        The metrics of evaluate() on slices of its predictions, without decoding again: all of them,
+        only_{domain} (the dialogues with that domain, restricted to its slots, as with -onlyd),
+        turn_{index} and slots_{number of slots with a value in the gold belief state}.
+        dialogue_domains maps each dialogue ID to its domains. Returns {slice: metrics} and writes
+        a prediction file per slice, but "all", with --genSample.
+        """
+        def select(keep_dialogue, keep_turn, keep_belief=lambda b: True):
+            prediction = {}
+            for d, v in all_prediction.items():
+                turns = dict((t, dict((k, [b for b in beliefs if keep_belief(b)]) for k, beliefs in cv.items()))
+                             for t, cv in v.items() if keep_dialogue(d) and keep_turn(t, cv))
+                if turns:
+                    prediction[d] = turns
+            return prediction
+
+        def active(cv):
+            return len([b for b in cv["turn_belief"] if not b.endswith("-none")])
+
+        slices = [("all", all_prediction, slot_temp)]
+        for domain in EXPERIMENT_DOMAINS:
+            in_domain = lambda b, domain=domain: b.startswith(domain + "-")
+            prediction = select(lambda d, domain=domain: domain in dialogue_domains[d], lambda t, cv: True, in_domain)
+            if prediction:
+                slices.append(("only_" + domain, prediction, [s for s in slot_temp if in_domain(s)]))
+        turn_ids = sorted(set(t for v in all_prediction.values() for t in v))
+        for turn_id in turn_ids:
+            slices.append(("turn_{}".format(turn_id), select(lambda d: True, lambda t, cv, turn_id=turn_id: t == turn_id), slot_temp))
+        counts = sorted(set(active(cv) for v in all_prediction.values() for cv in v.values()))
+        for count in counts:
+            slices.append(("slots_{}".format(count), select(lambda d: True, lambda t, cv, count=count: active(cv) == count), slot_temp))
+
+        results = {}
+        for name, prediction, slice_slots in slices:
+            joint_acc, F1, turn_acc = self.evaluate_metrics(prediction, "pred_bs_ptr", slice_slots)
+            results[name] = {"Joint Acc":joint_acc, "Turn Acc":turn_acc, "Joint F1":F1,
+                             "Turns":sum(len(v) for v in prediction.values())}
+            print(name, results[name])
+            # the "all" slice is evaluate()'s own prediction file
+            if args["genSample"] and name != "all":
+                if save_dir != "" and not os.path.exists(save_dir):
+                    os.mkdir(save_dir)
+                save_predictions(prediction, os.path.join(save_dir, "prediction_{}_{}_{}.{}".format(
+                    self.name, save_string, name, args["prediction_format"])))
+        return results
+
     def evaluate_metrics(self, all_prediction, from_which, slot_temp):
-        total, turn_acc, joint_acc, F1_pred, F1_count = 0, 0, 0, 0, 0
+        metrics = BeliefMetrics(self, slot_temp, from_which)
         for d, v in all_prediction.items():
-            for t in range(len(v)):
-                cv = v[t]
-                if set(cv["turn_belief"]) == set(cv[from_which]):
-                    joint_acc += 1
-                total += 1
-
-                # Compute prediction slot accuracy
-                temp_acc = self.compute_acc(set(cv["turn_belief"]), set(cv[from_which]), slot_temp)
-                turn_acc += temp_acc
-
-                # Compute prediction joint F1 score
-                temp_f1, temp_r, temp_p, count = self.compute_prf(set(cv["turn_belief"]), set(cv[from_which]))
-                F1_pred += temp_f1
-                F1_count += count
-
-        joint_acc_score = joint_acc / float(total) if total!=0 else 0
-        turn_acc_score = turn_acc / float(total) if total!=0 else 0
-        F1_score = F1_pred / float(F1_count) if F1_count!=0 else 0
-        return joint_acc_score, F1_score, turn_acc_score
+            for t, cv in v.items():
+                metrics.add(d, cv)
+        return metrics.scores()
 
     def compute_acc(self, gold, pred, slot_temp):
         miss_gold = 0
@@ -357,22 +576,112 @@ class TRADE(nn.Module):
                 precision, recall, F1, count = 0, 0, 0, 1
         return F1, recall, precision, count
 
+def load_artifact(path, device='cpu'):
+    """
+    The model written by TRADE.save_artifact(), in evaluation mode. The settings of the artifact replace
+    those of args, with a warning when they differ from a flag given on the command line. On the CPU the weights stay memory-mapped from the file, so the processes serving the
+    same artifact share their pages.
+    """
+    artifact = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+    if artifact.get('format') != 'TRADE':
+        raise ValueError("{} is not a TRADE model artifact".format(path))
+    for k, v in artifact['args'].items():
+        if args[k] != v and args[k] != parser.get_default(k):
+            print("[Warning] {}={} is replaced by {} of the model artifact".format(k, args[k], v))
+    args.update(artifact['args'])
+    # the embeddings are in the artifact, not read from the embedding files
+    args['load_embedding'] = 0
+
+    langs = []
+    for words in (artifact['lang'], artifact['mem_lang']):
+        lang = Lang()
+        lang.index2word = dict(enumerate(words))
+        lang.word2index = dict((w, i) for i, w in enumerate(words))
+        lang.n_words = len(words)
+        langs.append(lang)
+    slot_temp = artifact['slot_temp']
+    model = TRADE(artifact['hidden_size'], lang=langs, path=None, task=artifact['task'], lr=0, dropout=0,
+                  slots=[artifact['slots'], [], slot_temp, slot_temp], gating_dict=artifact['gating_dict'],
+                  t_total=-1, device=device, load_pretrained=False, bert_config=artifact.get('bert_config'))
+    # use the memory-mapped tensors as parameters instead of copying them
+    model.encoder.load_state_dict(artifact['encoder'], assign=True)
+    model.decoder.load_state_dict(artifact['decoder'], assign=True)
+    if 'domain_emb' in artifact:
+        model.decoder.domain_emb = artifact['domain_emb']
+    model.to(device)
+    model.eval()
+    return model
+
+def load_bert_layers(bert_model, num_layers, cache_dir=None):
+    """
+    Reads the pre-trained BERT weights of the embeddings, the pooler and the first `num_layers`
+    encoder layers, with keys matching a BertModel state dict.
+    """
+    if os.path.isdir(bert_model):
+        archive_file = os.path.join(bert_model, WEIGHTS_NAME)
+    else:
+        archive_file = BERT_PRETRAINED_MODEL_ARCHIVE_MAP.get(bert_model, bert_model)
+    resolved_archive_file = cached_path(archive_file, cache_dir=cache_dir)
+    try:
+        # memory-map the checkpoint so that only the tensors we keep are read from disk
+        pre_trained_dict = torch.load(resolved_archive_file, map_location='cpu', mmap=True)
+    except RuntimeError:
+        # checkpoints saved in the legacy (non zip) format
+        print("[Warning] Cannot memory-map {}, loading the whole checkpoint".format(resolved_archive_file))
+        pre_trained_dict = torch.load(resolved_archive_file, map_location='cpu')
+
+    state_dict = {}
+    for key in list(pre_trained_dict.keys()):
+        tensor = pre_trained_dict.pop(key)
+        if key.startswith('cls.'):
+            continue
+        if key.startswith('bert.'):
+            key = key[len('bert.'):]
+        if key.startswith('encoder.layer.') and int(key.split('.')[2]) >= num_layers:
+            continue
+        # old checkpoints name the LayerNorm parameters gamma/beta
+        key = key.replace('.gamma', '.weight').replace('.beta', '.bias')
+        state_dict[key] = tensor
+    return state_dict
+
+def maybe_checkpoint(enabled, function, *inputs):
+    """
+    function(*inputs), with the activations it creates recomputed during backward instead of being
+    kept when `enabled` and gradients are needed. Called on the modules of the current forward, so
+    that each DataParallel replica checkpoints its own parameters.
+    """
+    if enabled and torch.is_grad_enabled():
+        return checkpoint(function, *inputs, use_reentrant=False)
+    return function(*inputs)
+
 class BERTEncoder(nn.Module):
-    def __init__(self, hidden_size, dropout, device):
+    def __init__(self, hidden_size, dropout, device, load_pretrained=True, bert_config=None):
         super(BERTEncoder, self).__init__()
 
         self.device = device
-        # Load config and pre-trained model
-        pre_trained_model = BertModel.from_pretrained(args['bert_model'], cache_dir=PYTORCH_PRETRAINED_BERT_CACHE / 'distributed_{}'.format(-1))
-        bert_config = pre_trained_model.config
+        # Load config, or the one stored in a model artifact
+        cache_dir = PYTORCH_PRETRAINED_BERT_CACHE / 'distributed_{}'.format(-1)
+        if bert_config is not None:
+            bert_config = BertConfig.from_dict(bert_config)
+        else:
+            bert_config = BertConfig.from_pretrained(args['bert_model'], cache_dir=cache_dir)
 
-        # modify config if you want
-        bert_config.num_hidden_layers = args['num_bert_layers']
+            # modify config if you want
+            bert_config.num_hidden_layers = args['num_bert_layers']
 
         self.bert = BertModel(bert_config)
 
-        # load desired layers from pre-trained model
-        self.bert.load_state_dict(pre_trained_model.state_dict(), strict=False)
+        # load desired layers from pre-trained model, without materializing the full model
+        # (not when the weights are loaded afterwards, from a model artifact)
+        if load_pretrained:
+            state_dict = load_bert_layers(args['bert_model'], bert_config.num_hidden_layers, cache_dir=cache_dir)
+            missing = self.bert.load_state_dict(state_dict, strict=False).missing_keys
+            # the embeddings, the pooler and every kept layer must come from the checkpoint, not stay random
+            expected = [k for k in missing if k.split('.')[0] in ('embeddings', 'pooler')
+                        or (k.startswith('encoder.layer.') and int(k.split('.')[2]) < bert_config.num_hidden_layers)]
+            if expected:
+                raise ValueError("Pre-trained BERT weights missing from {}: {}".format(args['bert_model'], ", ".join(expected)))
+        self.grad_checkpoint = args['grad_checkpoint'] in ('bert', 'all')
 
         self.proj = nn.Linear(bert_config.hidden_size, hidden_size)
 
@@ -381,13 +690,28 @@ class BERTEncoder(nn.Module):
 
     def forward(self, all_input_ids, all_input_mask, all_segment_ids, all_sub_word_masks):
 
-        sequence_output, pooled_output = self.bert(all_input_ids, attention_mask=all_input_mask, token_type_ids=all_segment_ids)
+        if self.grad_checkpoint and self.training:
+            sequence_output, pooled_output = self.checkpointed_bert(all_input_ids, all_input_mask, all_segment_ids)
+        else:
+            sequence_output, pooled_output = self.bert(all_input_ids, attention_mask=all_input_mask, token_type_ids=all_segment_ids)
 
         output = self.proj(sequence_output)
         hidden = self.proj(pooled_output)
 
         return output, hidden
 
+    def checkpointed_bert(self, input_ids, attention_mask, token_type_ids):
+        """
+        The sequence and pooled outputs of BertModel.forward, with the activations of each layer
+        recomputed in backward: the layers are called here, BertEncoder.forward runs them itself.
+        """
+        mask = attention_mask.unsqueeze(1).unsqueeze(2).to(dtype=next(self.bert.parameters()).dtype)
+        mask = (1.0 - mask) * -10000.0
+        hidden_states = self.bert.embeddings(input_ids, token_type_ids=token_type_ids)
+        for layer in self.bert.encoder.layer:
+            hidden_states = maybe_checkpoint(True, layer, hidden_states, mask, None)[0]
+        return hidden_states, self.bert.pooler(hidden_states)
+
 class EncoderTPRNN(nn.Module):
     def __init__(self, vocab_size, hidden_size, dropout, device, cell_type, nSymbols, nRoles, dSymbols, dRoles, temperature, scale_val, train_scale, n_layers=1):
         super(EncoderTPRNN, self).__init__()
@@ -567,138 +891,223 @@ class Generator(nn.Module):
                 self.slot_w2i[slot.split("-")[1]] = len(self.slot_w2i)
         self.Slot_emb = nn.Embedding(len(self.slot_w2i), hidden_size)
         self.Slot_emb.weight.data.normal_(0, 0.1)
+        # tuple(slot_temp) -> (domain indices, slot indices), see slot_indices
+        self.slot_index = {}
+        # (name, device) -> [flat buffer, weak reference to its tensor in use by a graph or None] of the
+        # buffers reused by the decoding steps and across batches, see buffer; emptied after evaluate
+        self.workspace = {}
 
-    def forward(self, batch_size, encoded_hidden, encoded_outputs, encoded_lens, story, max_res_len, target_batches, use_teacher_forcing, slot_temp):
-        all_point_outputs = torch.zeros(len(slot_temp), batch_size, max_res_len, self.vocab_size, device=self.device)
-        all_gate_outputs = torch.zeros(len(slot_temp), batch_size, self.nb_gate, device=self.device)
-
-        # Get the slot embedding 
-        slot_emb_dict = {}
-        for i, slot in enumerate(slot_temp):
-            # Domain embbeding
-            if args['pretrain_domain_embeddings']:
-                assert slot.split("-")[0] in self.domain_w2i.keys()
-                domain_w2idx = [self.domain_w2i[slot.split("-")[0]]]
-                domain_w2idx = torch.tensor(domain_w2idx)
-                domain_w2idx = domain_w2idx.to(self.device)
-                domain_emb = self.domain_emb[domain_w2idx]
-            else:
-                assert slot.split("-")[0] in self.slot_w2i.keys()
-                domain_w2idx = [self.slot_w2i[slot.split("-")[0]]]
-                domain_w2idx = torch.tensor(domain_w2idx)
-                domain_w2idx = domain_w2idx.to(self.device)
-                domain_emb = self.Slot_emb(domain_w2idx)
-            # Slot embbeding
-            assert slot.split("-")[1] in self.slot_w2i.keys()
-            slot_w2idx = [self.slot_w2i[slot.split("-")[1]]]
-            slot_w2idx = torch.tensor(slot_w2idx)
-            slot_w2idx = slot_w2idx.to(self.device)
-            slot_emb = self.Slot_emb(slot_w2idx)
-
-            # Combine two embeddings as one query
-            self.W_slot_embed
-            if args['merge_embed'] == 'sum':
-                combined_emb = domain_emb + slot_emb
-            elif args['merge_embed'] == 'mean':
-                combined_emb = (domain_emb + slot_emb) / 2
-            elif args['merge_embed'] == 'concat':
-                combined_emb = self.W_slot_embed(torch.cat([domain_emb, slot_emb], dim=-1))
-            slot_emb_exp = combined_emb.expand_as(encoded_hidden)
-            if i == 0:
-                slot_emb_arr = slot_emb_exp.clone()
-            else:
-                slot_emb_arr = torch.cat((slot_emb_arr, slot_emb_exp), dim=0)
+        # the context * hidden attention products and the vocabulary-sized pointer-generator
+        # tensors of every decoding step are recomputed in backward
+        self.grad_checkpoint = args['grad_checkpoint'] in ('decoder', 'all')
+
+    def forward(self, batch_size, encoded_hidden, encoded_outputs, encoded_lens, story, max_res_len, target_batches, use_teacher_forcing, slot_temp, decode_rows=None):
+        """
+        decode_rows: if given, only these rows (slot * batch_size + example) are decoded after the first step,
+        which still runs on every row for the gates, and all_point_outputs is rows * max_res_len * vocab.
+        Returns all_point_outputs, all_gate_outputs, the predicted word ids |slot| * batch * max_res_len
+        (None with decode_rows) and an empty list.
+        """
+        # the outputs live in the workspace: without gradients (evaluation) they are only valid until the next call,
+        # every step writes all the rows so they need no zeroing
+        reuse = not torch.is_grad_enabled()
+        checkpointed = self.grad_checkpoint and self.training
+        device = encoded_hidden.device
+        if decode_rows is not None:
+            all_point_outputs = self.buffer('all_point_outputs', decode_rows.size(0), max_res_len, self.vocab_size, device=device)
+        else:
+            all_point_outputs = self.buffer('all_point_outputs', len(slot_temp), batch_size, max_res_len, self.vocab_size, device=device)
+        # with gradients, the copy distribution of each step is saved for backward: a buffer of its own per step,
+        # as the in-place writes into slices of a shared one would invalidate the saved ones (checkpointing
+        # recomputes the steps in backward, so it builds them again)
+        per_step = not reuse and not checkpointed
+
+        # Get the slot embedding: one query per (domain, slot), |slot| * emb
+        domain_idx, slot_idx = self.slot_indices(slot_temp)
+        if args['pretrain_domain_embeddings']:
+            domain_emb = self.domain_emb[domain_idx]
+        else:
+            domain_emb = self.Slot_emb(domain_idx)
+        slot_emb = self.Slot_emb(slot_idx)
+
+        # Combine two embeddings as one query
+        if args['merge_embed'] == 'sum':
+            combined_emb = domain_emb + slot_emb
+        elif args['merge_embed'] == 'mean':
+            combined_emb = (domain_emb + slot_emb) / 2
+        elif args['merge_embed'] == 'concat':
+            combined_emb = self.W_slot_embed(torch.cat([domain_emb, slot_emb], dim=-1))
+        slot_emb_dict = {slot: combined_emb[i:i+1] for i, slot in enumerate(slot_temp)}
+        slot_emb_arr = combined_emb.unsqueeze(1).expand(len(slot_temp), batch_size, self.hidden_size).contiguous() # |slot| * batch * emb
 
         if args["parallel_decode"]:
             # Compute pointer-generator output, putting all (domain, slot) in one batch
             decoder_input = self.dropout_layer(slot_emb_arr).view(-1, self.hidden_size) # (batch*|slot|) * emb
             hidden = encoded_hidden.repeat(1, len(slot_temp), 1) # 1 * (batch*|slot|) * emb
-            words_point_out = [[] for i in range(len(slot_temp))]
-            words_class_out = []
+            point_ids = None if decode_rows is not None else \
+                torch.empty(len(slot_temp) * batch_size, max_res_len, dtype=torch.long, device=self.device)
+            enc_out = encoded_outputs.repeat(len(slot_temp), 1, 1)
+            # context length of each row; batch_to_device turns the lengths into a tensor, where * would scale them
+            enc_len = encoded_lens.repeat(len(slot_temp)) if torch.is_tensor(encoded_lens) else encoded_lens * len(slot_temp)
+            story_rows = story.repeat(len(slot_temp), 1)
+            targets = target_batches.transpose(1, 0).reshape(-1, target_batches.size(2)) if use_teacher_forcing else None
             
             for wi in range(max_res_len):
                 dec_state, hidden = self.rnn(decoder_input.expand_as(hidden), hidden)
 
-                enc_out = encoded_outputs.repeat(len(slot_temp), 1, 1)
-                enc_len = encoded_lens * len(slot_temp)
-                context_vec, logits, prob = self.attend(enc_out, hidden.squeeze(0), enc_len)
+                context_vec, logits, prob = maybe_checkpoint(checkpointed, self.attend, enc_out, hidden.squeeze(0), enc_len)
 
                 if wi == 0: 
-                    all_gate_outputs = torch.reshape(self.W_gate(context_vec), all_gate_outputs.size())
-
-                p_vocab = self.attend_vocab(self.embedding.weight, hidden.squeeze(0))
-                p_gen_vec = torch.cat([dec_state.squeeze(0), context_vec, decoder_input], -1)
-                vocab_pointer_switches = self.sigmoid(self.W_ratio(p_gen_vec))
-                p_context_ptr = torch.zeros(p_vocab.size())
-                p_context_ptr = p_context_ptr.to(self.device)
-
-                prob = prob.to(self.device)
-                p_context_ptr.scatter_add_(1, story.repeat(len(slot_temp), 1), prob)
-
-                final_p_vocab = (1 - vocab_pointer_switches).expand_as(p_context_ptr) * p_context_ptr + \
-                                vocab_pointer_switches.expand_as(p_context_ptr) * p_vocab
+                    all_gate_outputs = torch.reshape(self.W_gate(context_vec), (len(slot_temp), batch_size, self.nb_gate))
+                    if decode_rows is not None:
+                        # the gates need every row, the values only the sampled ones
+                        dec_state, hidden = dec_state[:, decode_rows], hidden[:, decode_rows]
+                        context_vec, prob = context_vec[decode_rows], prob[decode_rows]
+                        decoder_input = decoder_input[decode_rows]
+                        enc_out, story_rows = enc_out[decode_rows], story_rows[decode_rows]
+                        enc_len = torch.as_tensor(enc_len, device=decode_rows.device)[decode_rows]
+                        if targets is not None:
+                            targets = targets[decode_rows]
+
+                if reuse:
+                    # written in place, (|slot|*batch) * |v| view of the step
+                    final_p_vocab = self.pointer_generator(dec_state, hidden, context_vec, prob, decoder_input, story_rows,
+                                                           all_point_outputs[:, :, wi, :].view(-1, self.vocab_size))
+                elif per_step:
+                    context_ptr = self.buffer('p_context_ptr', dec_state.size(1), self.vocab_size, device=device)
+                    final_p_vocab = self.pointer_generator(dec_state, hidden, context_vec, prob, decoder_input, story_rows,
+                                                           context_ptr=context_ptr)
+                else:
+                    final_p_vocab = maybe_checkpoint(checkpointed, self.pointer_generator, dec_state, hidden, context_vec, prob, decoder_input, story_rows)
                 pred_word = torch.argmax(final_p_vocab, dim=1)
-                words = [self.lang.index2word[w_idx.item()] for w_idx in pred_word]
-                
-                for si in range(len(slot_temp)):
-                    words_point_out[si].append(words[si*batch_size:(si+1)*batch_size])
-                
-                all_point_outputs[:, :, wi, :] = torch.reshape(final_p_vocab, (len(slot_temp), batch_size, self.vocab_size))
+
+                if decode_rows is not None:
+                    # training only, the predicted words are not needed
+                    all_point_outputs[:, wi, :] = final_p_vocab
+                else:
+                    point_ids[:, wi] = pred_word
+                    if not reuse:
+                        all_point_outputs[:, :, wi, :] = torch.reshape(final_p_vocab, (len(slot_temp), batch_size, self.vocab_size))
                 
                 if use_teacher_forcing:
-                    decoder_input = self.embedding(torch.flatten(target_batches[:, :, wi].transpose(1,0)))
+                    decoder_input = self.embedding(targets[:, wi])
                 else:
                     decoder_input = self.embedding(pred_word)   
                 
                 decoder_input = decoder_input.to(self.device)
+            if point_ids is not None:
+                point_ids = point_ids.view(len(slot_temp), batch_size, max_res_len)
         else:
             # Compute pointer-generator output, decoding each (domain, slot) one-by-one
-            words_point_out = []
+            point_ids = torch.empty(len(slot_temp), batch_size, max_res_len, dtype=torch.long, device=self.device)
+            all_gate_outputs = self.buffer('all_gate_outputs', len(slot_temp), batch_size, self.nb_gate, device=device)
             counter = 0
             for slot in slot_temp:
                 hidden = encoded_hidden
-                words = []
                 slot_emb = slot_emb_dict[slot]
                 decoder_input = self.dropout_layer(slot_emb).expand(batch_size, self.hidden_size)
                 for wi in range(max_res_len):
                     dec_state, hidden = self.rnn(decoder_input.expand_as(hidden), hidden)
-                    context_vec, logits, prob = self.attend(encoded_outputs, hidden.squeeze(0), encoded_lens)
+                    context_vec, logits, prob = maybe_checkpoint(checkpointed, self.attend, encoded_outputs, hidden.squeeze(0), encoded_lens)
                     if wi == 0: 
                         all_gate_outputs[counter] = self.W_gate(context_vec)
-                    p_vocab = self.attend_vocab(self.embedding.weight, hidden.squeeze(0))
-                    p_gen_vec = torch.cat([dec_state.squeeze(0), context_vec, decoder_input], -1)
-                    vocab_pointer_switches = self.sigmoid(self.W_ratio(p_gen_vec))
-                    p_context_ptr = torch.zeros(p_vocab.size())
-                    p_context_ptr = p_context_ptr.to(self.device)
-                    p_context_ptr.scatter_add_(1, story, prob)
-                    final_p_vocab = (1 - vocab_pointer_switches).expand_as(p_context_ptr) * p_context_ptr + \
-                                    vocab_pointer_switches.expand_as(p_context_ptr) * p_vocab
+                    if reuse:
+                        final_p_vocab = self.pointer_generator(dec_state, hidden, context_vec, prob, decoder_input, story,
+                                                               all_point_outputs[counter, :, wi, :])
+                    elif per_step:
+                        context_ptr = self.buffer('p_context_ptr', batch_size, self.vocab_size, device=device)
+                        final_p_vocab = self.pointer_generator(dec_state, hidden, context_vec, prob, decoder_input, story,
+                                                               context_ptr=context_ptr)
+                        all_point_outputs[counter, :, wi, :] = final_p_vocab
+                    else:
+                        final_p_vocab = maybe_checkpoint(checkpointed, self.pointer_generator, dec_state, hidden, context_vec, prob, decoder_input, story)
+                        all_point_outputs[counter, :, wi, :] = final_p_vocab
                     pred_word = torch.argmax(final_p_vocab, dim=1)
-                    words.append([self.lang.index2word[w_idx.item()] for w_idx in pred_word])
-                    all_point_outputs[counter, :, wi, :] = final_p_vocab
+                    point_ids[counter, :, wi] = pred_word
                     if use_teacher_forcing:
                         decoder_input = self.embedding(target_batches[:, counter, wi]) # Chosen word is next input
                     else:
                         decoder_input = self.embedding(pred_word)   
                     decoder_input = decoder_input.to(self.device)
                 counter += 1
-                words_point_out.append(words)
         
-        return all_point_outputs, all_gate_outputs, words_point_out, []
+        return all_point_outputs, all_gate_outputs, point_ids, []
+
+    def slot_indices(self, slot_temp):
+        """Embedding indices of the domain and of the slot name of each slot, built once per slot list on the device."""
+        key = tuple(slot_temp)
+        if key not in self.slot_index:
+            domain_w2i = self.domain_w2i if args['pretrain_domain_embeddings'] else self.slot_w2i
+            self.slot_index[key] = (
+                torch.tensor([domain_w2i[slot.split("-")[0]] for slot in slot_temp], device=self.device),
+                torch.tensor([self.slot_w2i[slot.split("-")[1]] for slot in slot_temp], device=self.device))
+        return self.slot_index[key]
+
+    def buffer(self, name, *size, device=None):
+        """
+        Uninitialized tensor of `size` backed by a workspace buffer that is reused across steps and batches,
+        and only reallocated to grow. Each name has a pool of buffers: one still referred to by a graph
+        (given out with gradients, until its backward frees it) is skipped, so the decoding steps of a
+        training forward get one each, as does a second forward before the backward of the first.
+        """
+        device = self.device if device is None else device
+        numel = int(np.prod(size))
+        pool = self.workspace.setdefault((name, str(device)), [])
+        for entry in pool:
+            if entry[1] is None or entry[1]() is None:
+                break
+        else:
+            entry = [torch.empty(0, device=device), None]
+            pool.append(entry)
+        if entry[0].numel() < numel:
+            entry[0] = torch.empty(numel, device=device)
+        # detached, so that the in-place writes of a training step do not chain its graph to the previous one;
+        # every view of it keeps the detached tensor alive
+        base = entry[0].detach()
+        entry[1] = weakref.ref(base) if torch.is_grad_enabled() else None
+        return base[:numel].view(*size)
+
+    def release_workspace(self):
+        """Frees the workspace buffers, e.g. the evaluation-sized ones once evaluation is over."""
+        self.workspace = {}
+
+    def pointer_generator(self, dec_state, hidden, context_vec, prob, decoder_input, story, out=None, context_ptr=None):
+        """
+        Mix of the vocabulary distribution and of the attention copied onto the context words `story`.
+        With `out` (no gradients) the result is written there and the copy distribution goes to the workspace.
+        With `context_ptr` the copy distribution is built there, in the workspace buffer of the training step.
+        """
+        p_vocab = self.attend_vocab(self.embedding.weight, hidden.squeeze(0))
+        # W_ratio of [dec_state, context_vec, decoder_input] without building the concatenation
+        w, h = self.W_ratio.weight, self.hidden_size
+        p_gen = torch.addmm(self.W_ratio.bias, dec_state.squeeze(0), w[:, :h].t())
+        p_gen = p_gen.addmm_(context_vec, w[:, h:2*h].t()).addmm_(decoder_input, w[:, 2*h:].t())
+        vocab_pointer_switches = self.sigmoid(p_gen)
+        if context_ptr is not None:
+            p_context_ptr = context_ptr.zero_()
+        elif out is None:
+            p_context_ptr = torch.zeros_like(p_vocab)
+        else:
+            p_context_ptr = self.buffer('p_context_ptr', *p_vocab.size()).zero_()
+        p_context_ptr.scatter_add_(1, story, prob)
+
+        # (1 - switch) * p_context_ptr + switch * p_vocab
+        if out is None:
+            return torch.lerp(p_context_ptr, p_vocab, vocab_pointer_switches)
+        return torch.lerp(p_context_ptr, p_vocab, vocab_pointer_switches, out=out)
 
     def attend(self, seq, cond, lens):
         """
         attend over the sequences `seq` using the condition `cond`.
         """
 
-        scores_ = cond.unsqueeze(1).expand_as(seq).mul(seq).sum(2)
-        max_len = max(lens)
-        # import pdb; pdb.set_trace()
-        for i, l in enumerate(lens):
-            if l < max_len:
-                scores_.data[i, l:] = -np.inf
+        scores_ = torch.bmm(seq, cond.unsqueeze(2)).squeeze(2)
+        lens = torch.as_tensor(lens, device=scores_.device)
+        # the positions past the length of the first len(lens) rows
+        padding = torch.arange(scores_.size(1), device=scores_.device).unsqueeze(0) >= lens.unsqueeze(1)
+        scores_.data[:lens.size(0)].masked_fill_(padding, -np.inf)
         scores = F.softmax(scores_, dim=1)
-        context = scores.unsqueeze(2).expand_as(seq).mul(seq).sum(1)
+        context = torch.bmm(scores.unsqueeze(1), seq).squeeze(1)
         return context, scores_, scores
 
     def attend_vocab(self, seq, cond):
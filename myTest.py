@@ -1,20 +1,26 @@
-from models.TRADE import TRADE
+from models.TRADE import TRADE, load_artifact
 from utils.config import args
 import warnings
 
 '''
 python3 myTest.py -ds= -path= -bsz=
+python3 myTest.py -ds= --artifact= -bsz=
 '''
 
 warnings.simplefilter("ignore", UserWarning)
 
 def run():
 
-    directory = args['path'].split("/")
-    print(directory)
-    HDD = directory[2].split('HDD')[1].split('BSZ')[0]
-    decoder = directory[1].split('-')[0]
-    BSZ = int(args['batch']) if args['batch'] else int(directory[2].split('BSZ')[1].split('DR')[0])
+    if args['artifact']:
+        # the settings and the vocabularies are those of the artifact
+        model = load_artifact(args['artifact'], device='cpu')
+        HDD, decoder, BSZ = model.hidden_size, model.name, int(args['batch']) if args['batch'] else 32
+    else:
+        directory = args['path'].split("/")
+        print(directory)
+        HDD = directory[2].split('HDD')[1].split('BSZ')[0]
+        decoder = directory[1].split('-')[0]
+        BSZ = int(args['batch']) if args['batch'] else int(directory[2].split('BSZ')[1].split('DR')[0])
     args["decoder"] = decoder
     args["HDD"] = HDD
     print("HDD", HDD, "decoder", decoder, "BSZ", BSZ)
@@ -24,11 +30,14 @@ def run():
     else:
         print("You need to provide the --dataset information")
 
-    train, dev, test, test_special, lang, SLOTS_LIST, gating_dict, max_word = prepare_data_seq(False, args['task'], False, batch_size=BSZ)
+    train, dev, test, test_special, lang, SLOTS_LIST, gating_dict, max_word = prepare_data_seq(
+        False, args['task'], False, batch_size=BSZ, langs=[model.lang, model.mem_lang] if args['artifact'] else None)
 
     # import pdb; pdb.set_trace()
 
-    if args['decoder'] == 'TRADE':
+    if args['artifact']:
+        print("MODEL {} LOADED".format(args['artifact']))
+    elif args['decoder'] == 'TRADE':
         model = TRADE(
             int(HDD),
             lang=lang,
@@ -52,10 +61,14 @@ def run():
         print("Test Set on 4 domains...")
         acc_test_4d = model.evaluate(test_special, 1e7, SLOTS_LIST[2], device='cpu', save_string="test_4dom")
 
-    # TODO: add test -onlyd instead of doing it in evaluate-job.sh
-
     print("Test Set ...")
-    acc_test = model.evaluate(test, 1e7, SLOTS_LIST[3], device='cpu', save_string="test")
+    acc_test = model.evaluate(test, 1e7, SLOTS_LIST[3], device='cpu', save_string="test", keep_predictions=args["eval_slices"])
+
+    if args["eval_slices"]:
+        # by domain, turn and number of slots, from the predictions above
+        print("Test Set slices ...")
+        dialogue_domains = dict(zip(test.dataset.ID, test.dataset.domains))
+        model.evaluate_slices(model.last_prediction, dialogue_domains, SLOTS_LIST[3], save_string="test")
 
 if __name__ == '__main__':
     run()
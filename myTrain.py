@@ -6,12 +6,15 @@ import shutil
 import os
 import warnings
 import sys
+import time
 
 from torch.optim import lr_scheduler
 from transformers.optimization import AdamW, WarmupLinearSchedule
 
 from models.TRADE import TRADE
 from utils.config import args
+from utils.checkpoint import get_rng_state, set_rng_state
+from utils.logger import Logger, PhaseTimer
 
 '''
 python myTrain.py -dec= -bsz= -hdd= -dr= -lr=
@@ -19,7 +22,29 @@ python myTrain.py -dec= -bsz= -hdd= -dr= -lr=
 
 warnings.simplefilter("ignore", UserWarning)
 
-def run():
+def save_checkpoint(core, epoch, step, avg_best, cnt, acc, full_best=0.0):
+    """Queue the resume checkpoint: `step` batches of `epoch` are done."""
+    core.checkpoints.save(args['log_dir'], {'checkpoint.pt': {
+        'model': core.state_dict(),
+        'optimizer': core.optimizer.state_dict(),
+        'scheduler': core.scheduler.state_dict(),
+        'checkpoints': core.checkpoints.state_dict(),
+        'rng': get_rng_state(),
+        'noise': core.noise.get_state(),
+        'epoch': epoch,
+        'step': step,
+        'avg_best': avg_best,
+        'cnt': cnt,
+        'acc': acc,
+        'full_best': full_best,
+    }})
+
+def run(prepare_data=None, regularizer=None):
+    """
+    Trains a model. prepare_data() replaces prepare_data_seq() to train on other data (the model is
+    loaded from -path if given), and a utils.continual.Regularizer hooks into every step, see continual_train.py.
+    Returns the model.
+    """
 
     seed = args['seed']
 
@@ -29,41 +54,78 @@ def run():
     early_stop = args['earlyStop']
 
     if args['dataset']=='multiwoz':
-        from utils.utils_multiWOZ_DST import prepare_data_seq
+        from utils.utils_multiWOZ_DST import prepare_data_seq, batch_to_device
         early_stop = None
     else:
         print("You need to provide the --dataset information")
         exit(1)
 
+    # the process group is needed before loading the data to shard the training set
+    distributed = args['local_rank'] != -1
+    if distributed:
+        if args['async_eval']:
+            raise ValueError("--async_eval is not supported in distributed training")
+        if args['imbalance_sampler']:
+            raise ValueError("--imbalance_sampler is not supported in distributed training")
+        backend = args['dist_backend'] if args['dist_backend'] else ('nccl' if torch.cuda.is_available() else 'gloo')
+        if backend == 'nccl':
+            torch.cuda.set_device(args['local_rank'])
+        torch.distributed.init_process_group(backend=backend)
+    if args['async_eval'] and args['proxy_dev_ratio'] > 0:
+        raise ValueError("--proxy_dev_ratio is not supported with --async_eval")
+    if not args['batch']:
+        raise ValueError("-bsz is required: the training batch size, or with -btok the evaluation batch size")
+    # rank 0 evaluates, saves and writes the logs
+    is_main = not distributed or torch.distributed.get_rank() == 0
+
     # Configure models and load data
     avg_best, cnt, acc = 0.0, 0, 0.0
-    train, dev, test, test_special, lang, SLOTS_LIST, gating_dict, max_word = prepare_data_seq(True, args['task'], False, batch_size=int(args['batch']))
+    # with --proxy_dev_ratio avg_best is the best proxy score and full_best the best full dev score
+    full_best = 0.0
+    if not is_main:
+        # let rank 0 write the vocabulary files first
+        torch.distributed.barrier()
+    if prepare_data is None:
+        train, dev, test, test_special, lang, SLOTS_LIST, gating_dict, max_word = prepare_data_seq(True, args['task'], False, batch_size=int(args['batch']))
+    else:
+        train, dev, test, test_special, lang, SLOTS_LIST, gating_dict, max_word = prepare_data()
+    if args['preprocess_only']:
+        return
+    if args['batch_tokens'] > 0:
+        print("Training batches of up to {} padded context words (-btok)".format(args['batch_tokens']))
+    else:
+        print("Training batches of {} examples".format(train.batch_size))
 
-    if os.path.exists(args['log_dir']):
-        if args['delete_ok']:
-            shutil.rmtree(args['log_dir'])
-        else:
-            raise ValueError("Output directory ({}) already exists and is not empty.".format(args['log_dir']))
-    os.makedirs(args['log_dir'], exist_ok=False)
+    if is_main:
+        if os.path.exists(args['log_dir']) and not args['resume']:
+            if args['delete_ok']:
+                shutil.rmtree(args['log_dir'])
+            else:
+                raise ValueError("Output directory ({}) already exists and is not empty.".format(args['log_dir']))
+        os.makedirs(args['log_dir'], exist_ok=args['resume'])
+        if distributed:
+            torch.distributed.barrier()
 
     # create logger
     logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
                     datefmt='%m/%d/%Y %H:%M:%S',
                     level=logging.INFO)
     logger = logging.getLogger(__name__)
-    log_file = os.path.join(args['log_dir'], 'log.txt')
-    fh = logging.FileHandler(log_file, mode='w')
-    fh.setLevel(logging.DEBUG)
-    logger.addHandler(fh)
+    if is_main:
+        log_file = os.path.join(args['log_dir'], 'log.txt')
+        fh = logging.FileHandler(log_file, mode='a' if args['resume'] else 'w')
+        fh.setLevel(logging.DEBUG)
+        logger.addHandler(fh)
 
-    if args['local_rank'] == -1:
+    if not distributed:
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         n_gpu = torch.cuda.device_count()
-    else:
-        torch.cuda.set_device(args['local_rank'])
+    elif torch.distributed.get_backend() == 'nccl':
         device = torch.device("cuda", args['local_rank'])
         n_gpu = 1
-        torch.distributed.init_process_group(backend='nccl')
+    else:
+        device = torch.device("cpu")
+        n_gpu = 0
 
     random.seed(seed)
     np.random.seed(seed)
@@ -71,11 +133,15 @@ def run():
     if n_gpu > 0:
         torch.cuda.manual_seed_all(seed)
 
-    logger.info("device: {} n_gpu: {}, distributed training: {}".format(device, n_gpu, bool(args['local_rank'] != -1)))
+    logger.info("device: {} n_gpu: {}, distributed training: {}".format(device, n_gpu, distributed))
 
     if args['gradient_accumulation_steps'] < 1:
         raise ValueError("Invalid gradient_accumulation_steps parameter: {}, should be >= 1".format(args['gradient_accumulation_steps']))
-    num_train_steps = int(len(train) / args['batch'] / args['gradient_accumulation_steps'] * args['max_epochs'])
+    if args['batch_tokens'] > 0:
+        # the batches of the token budget are already counted
+        num_train_steps = int(len(train) / args['gradient_accumulation_steps'] * args['max_epochs'])
+    else:
+        num_train_steps = int(len(train) / args['batch'] / args['gradient_accumulation_steps'] * args['max_epochs'])
 
     if args['decoder'] == 'TRADE':
         model = TRADE(
@@ -95,62 +161,212 @@ def run():
         raise ValueError("Model {} specified does not exist".format(args['decoder']))
 
     model.to(device)
-    if args['local_rank'] != -1:
-        try:
-            from apex.parallel import DistributedDataParallel as DDP
-        except ImportError:
-            raise ImportError(
-                "Please install apex from https://www.github.com/nvidia/apex to use distributed and fp16 training.")
-
-        model = DDP(model)
+    if distributed:
+        # not every parameter gets a gradient at each step (e.g. the embeddings of slots absent from the batch)
+        model = torch.nn.parallel.DistributedDataParallel(
+            model,
+            device_ids=[args['local_rank']] if device.type == 'cuda' else None,
+            find_unused_parameters=True)
     elif n_gpu > 1:
         model = torch.nn.DataParallel(model)
 
     core = model.module if hasattr(model, 'module') else model
 
-    for epoch in range(args['max_epochs']):
+    start_epoch, start_step = 0, 0
+    resume_path = os.path.join(args['log_dir'], 'checkpoint.pt')
+    if args['resume'] and os.path.exists(resume_path):
+        checkpoint = torch.load(resume_path, map_location='cpu')
+        core.load_state_dict(checkpoint['model'])
+        core.optimizer.load_state_dict(checkpoint['optimizer'])
+        core.scheduler.load_state_dict(checkpoint['scheduler'])
+        core.checkpoints.load_state_dict(checkpoint['checkpoints'])
+        set_rng_state(checkpoint['rng'])
+        if 'noise' in checkpoint:
+            core.noise.set_state(checkpoint['noise'])
+        start_epoch, start_step = checkpoint['epoch'], checkpoint['step']
+        avg_best, cnt, acc = checkpoint['avg_best'], checkpoint['cnt'], checkpoint['acc']
+        full_best = checkpoint.get('full_best', 0.0)
+        if start_step > 0 and not hasattr(train.batch_sampler, 'set_epoch') and not hasattr(train.sampler, 'set_epoch'):
+            print("[Warning] the training sampler cannot be resumed mid-epoch, restarting epoch {}".format(start_epoch))
+            start_step = 0
+        logger.info("Resumed from {} at epoch {} step {}".format(resume_path, start_epoch, start_step))
+
+    if regularizer is None:
+        from utils.continual import Regularizer
+        regularizer = Regularizer()
+    regularizer.setup(core, device)
+
+    teacher_cache = None
+    if args['distill_teacher']:
+        from utils.distill import TeacherCache, load_teacher, teacher_loader, timed_evaluate
+        cache_path = args['distill_cache'] if args['distill_cache'] else \
+            os.path.join(args['distill_teacher'], 'teacher-cache-top{}.pt'.format(args['distill_topk']))
+        if is_main:
+            teacher = load_teacher(args['distill_teacher'], lang, SLOTS_LIST, gating_dict, device, nb_train_vocab=max_word)
+            if not os.path.exists(cache_path):
+                # every training example, not only the shard of this process (-bsz at a time with -btok)
+                all_train = teacher_loader(train, batch_size=train.batch_size or int(args['batch']))
+                TeacherCache.build(teacher, all_train, SLOTS_LIST[1], device, args['distill_topk']).save(cache_path)
+                print("Teacher outputs cached in {}".format(cache_path))
+            teacher_acc, teacher_time = timed_evaluate(teacher, teacher_loader(dev), SLOTS_LIST[2], device)
+            del teacher
+        if distributed:
+            torch.distributed.barrier()
+        print("Loading teacher outputs from {}".format(cache_path))
+        teacher_cache = TeacherCache.load(cache_path)
+
+    proxy_dev = None
+    if args['proxy_dev_ratio'] > 0:
+        from utils.utils_multiWOZ_DST import proxy_loader
+        proxy_dev = proxy_loader(dev, args['proxy_dev_ratio'], seed)
+        print("Proxy dev set: {} of {} batches".format(len(proxy_dev), len(dev)))
+
+    evaluator = None
+    if args['async_eval']:
+        from utils.async_eval import AsyncEvaluator
+        evaluator = AsyncEvaluator(dev, SLOTS_LIST[2], dict(
+            hidden_size=int(args['hidden']),
+            lang=lang,
+            path=None,
+            task=args['task'],
+            lr=0,
+            dropout=0,
+            slots=SLOTS_LIST,
+            gating_dict=gating_dict,
+            t_total=-1,
+            device=str(device),
+            nb_train_vocab=max_word,
+            ), max_pending=args['max_pending_evals'])
+
+    # dev scores are always logged, step times only with --metrics_every
+    metrics = Logger(args['log_dir']) if is_main else None
+    timer = PhaseTimer(enabled=is_main and args['metrics_every'] > 0, synchronize=device.type == 'cuda')
+    core.timer = timer
+
+    for epoch in range(start_epoch, args['max_epochs']):
         print("Epoch:{}".format(epoch))
+        first_step = start_step if epoch == start_epoch else 0
+        if hasattr(train.batch_sampler, 'set_epoch'):
+            train.batch_sampler.set_epoch(epoch, start=first_step)
+        elif hasattr(train.sampler, 'set_epoch'):
+            train.sampler.set_epoch(epoch, start=first_step * train.batch_size)
         # Run the train function
-        pbar = enumerate(train)
+        pbar = enumerate(train, first_step)
+        # the evaluation of the previous epoch is not part of the step times
+        timer.reset()
+        interval_loss = 0.0
+        # examples in the batches accumulated since the last optimizer step
+        window_examples = 0
+        regularizer.zero_grad(core)
+        data_start = time.perf_counter()
         for i, data in pbar:
-            batch = {}
-            # wrap all numerical values as tensors for multi-gpu training
-            for k, v in data.items():
-                if isinstance(v, torch.Tensor):
-                    batch[k] = v.to(device)
-                elif isinstance(v, list):
-                    if k in ['ID', 'turn_belief', 'context_plain', 'turn_uttr_plain']:
-                        batch[k] = v
-                    else:
-                        batch[k] = torch.tensor(v).to(device)
-                else:
-                    # print('v is: {} and this ignoring {}'.format(v, k))
-                    pass
-
-            loss = model(batch, int(args['clip']), SLOTS_LIST[1], reset=(i==0), n_gpu=n_gpu)
+            if timer.enabled:
+                # time waiting for the batch, of which collate_fn took collate_time
+                timer.add('data', time.perf_counter() - data_start - data['collate_time'])
+                timer.add('collate', data['collate_time'])
+            batch = batch_to_device(data, device)
+            if teacher_cache is not None:
+                batch.update(teacher_cache.batch(data, device))
+
+            regularizer.before_forward(core, i)
+            loss = model(batch, int(args['clip']), SLOTS_LIST[1], reset=(i==first_step), n_gpu=n_gpu)
 
             if n_gpu > 1:
                 loss = loss.mean()  # mean() to average on multi-gpu.
-            if args['gradient_accumulation_steps'] > 1:
+            loss = regularizer.loss(core, loss)
+            if args['batch_tokens'] > 0:
+                # batches differ in size: weight each one by its examples, the sum is divided before the step
+                loss = loss * len(data['ID'])
+                window_examples += len(data['ID'])
+            elif args['gradient_accumulation_steps'] > 1:
                 loss = loss / args['gradient_accumulation_steps']
 
-            loss.backward()
+            with timer.phase('backward'):
+                loss.backward()
 
             if (i + 1) % args['gradient_accumulation_steps'] == 0:
-                torch.nn.utils.clip_grad_norm_(core.parameters(), args['clip'])
-                core.optimizer.step()
-                if isinstance(core.scheduler, WarmupLinearSchedule):
-                    core.scheduler.step()
+                with timer.phase('optimizer'):
+                    if args['batch_tokens'] > 0:
+                        scale = 1.0 / window_examples
+                        if distributed:
+                            # DDP averaged the gradients of the processes, whose batches differ in size:
+                            # back to their sum, divided by the examples of all of them
+                            total = torch.tensor(float(window_examples), device=device)
+                            torch.distributed.all_reduce(total)
+                            scale = torch.distributed.get_world_size() / total.item()
+                        for p in core.parameters():
+                            if p.grad is not None:
+                                p.grad.mul_(scale)
+                        window_examples = 0
+                    regularizer.before_step(core)
+                    torch.nn.utils.clip_grad_norm_(core.parameters(), args['clip'])
+                    core.optimizer.step()
+                    if isinstance(core.scheduler, WarmupLinearSchedule):
+                        core.scheduler.step()
+                    regularizer.zero_grad(core)
+
+                if is_main and args['checkpoint_every'] > 0 and (i + 1) % args['checkpoint_every'] == 0:
+                    save_checkpoint(core, epoch, i + 1, avg_best, cnt, acc, full_best)
+
+            if timer.enabled:
+                timer.count(len(data['ID']), sum(data['context_len']))
+                interval_loss += core.loss_grad.item()
+                if timer.steps == args['metrics_every']:
+                    metrics.log(epoch * len(train) + i + 1, epoch=epoch, loss=interval_loss / timer.steps,
+                                lr=core.optimizer.param_groups[0]['lr'], **timer.summary())
+                    interval_loss = 0.0
+            data_start = time.perf_counter()
 
         print(core.print_loss(), flush=True) #TODO
 
-        if((epoch+1) % int(args['evalp']) == 0):
+        # (epoch, acc, seconds per batch, weights to save or None if evaluate already saved them)
+        results = []
+        if evaluator is not None:
+            if((epoch+1) % int(args['evalp']) == 0):
+                results = evaluator.submit(epoch, core)
+            else:
+                results = evaluator.poll()
+        elif((epoch+1) % int(args['evalp']) == 0):
+            start = time.time()
+            if is_main and proxy_dev is not None:
+                # patience and the learning rate follow the proxy score, the saved models the full dev set
+                acc = core.evaluate(proxy_dev, 1e7, SLOTS_LIST[2], device, early_stop)
+                eval_time = (time.time() - start) / max(len(proxy_dev), 1)
+                _, low, high = core.last_metrics.joint_acc_interval()
+                print("Proxy dev joint acc: {:.4f} (95% CI {:.4f}-{:.4f}), best {:.4f}".format(acc, low, high, avg_best))
+                if ((epoch + 1) // int(args['evalp'])) % args['full_eval_every'] == 0 or low > avg_best:
+                    full_start = time.time()
+                    full_acc = core.evaluate(dev, full_best, SLOTS_LIST[2], device, early_stop)
+                    full_best = max(full_best, full_acc)
+                    if metrics is not None:
+                        metrics.log((epoch + 1) * len(train), epoch=epoch, dev_acc=full_acc,
+                                    eval_sec_per_batch=(time.time() - full_start) / max(len(dev), 1))
+                if metrics is not None:
+                    metrics.log((epoch + 1) * len(train), epoch=epoch, proxy_dev_acc=acc, proxy_low=low, proxy_high=high,
+                                proxy_sec_per_batch=eval_time)
+            elif is_main:
+                acc = core.evaluate(dev, avg_best, SLOTS_LIST[2], device, early_stop)
+            if distributed:
+                # the other ranks need the score to take the same scheduler and early stopping decisions
+                acc_tensor = torch.tensor([acc if is_main else 0.0], dtype=torch.float64, device=device)
+                torch.distributed.broadcast(acc_tensor, 0)
+                acc = acc_tensor.item()
+            if proxy_dev is None or not is_main:
+                eval_time = (time.time() - start) / max(len(dev), 1)
+            results = [(epoch, acc, eval_time, None)]
 
-            acc = core.evaluate(dev, avg_best, SLOTS_LIST[2], device, early_stop)
+        stop = False
+        for eval_epoch, acc, eval_time, state in results:
+            if evaluator is not None:
+                print("Dev evaluation of epoch {}: {:.4f}".format(eval_epoch, acc))
+            if metrics is not None and proxy_dev is None:
+                metrics.log((eval_epoch + 1) * len(train), epoch=eval_epoch, dev_acc=acc, eval_sec_per_batch=eval_time)
             if isinstance(core.scheduler, lr_scheduler.ReduceLROnPlateau):
                 core.scheduler.step(acc)
 
             if(acc >= avg_best):
+                if state is not None:
+                    core.save_model('ACC-{:.4f}'.format(acc), score=acc, state=state)
                 avg_best = acc
                 cnt = 0
                 best_model = core
@@ -158,8 +374,33 @@ def run():
                 cnt += 1
 
             if(cnt == args["patience"] or (acc==1.0 and early_stop==None)):
-                print("Ran out of patient, early stop...")
-                break
+                stop = True
+
+        if stop:
+            print("Ran out of patient, early stop...")
+            break
+
+        if is_main:
+            save_checkpoint(core, epoch + 1, 0, avg_best, cnt, acc, full_best)
+
+    if evaluator is not None:
+        # the last evaluations only matter for the saved model
+        for eval_epoch, acc, eval_time, state in evaluator.close():
+            print("Dev evaluation of epoch {}: {:.4f}".format(eval_epoch, acc))
+            if(acc >= avg_best):
+                core.save_model('ACC-{:.4f}'.format(acc), score=acc, state=state)
+                avg_best = acc
+
+    core.checkpoints.wait()
+    if metrics is not None:
+        metrics.close()
+    if distributed:
+        torch.distributed.destroy_process_group()
+
+    if teacher_cache is not None and is_main:
+        print("Teacher dev acc: {:.4f} ({:.3f}s/batch), student best dev acc: {:.4f} ({:.3f}s/batch)".format(
+            teacher_acc, teacher_time, avg_best, eval_time))
+    return core
 
 if __name__ == '__main__':
     run()
\ No newline at end of file
@@ -0,0 +1,10 @@
+#!/usr/bin/env bash
+
+# data-parallel training on one machine, one process per cpu group (gloo) or per gpu (nccl)
+# usage: ./run-distributed.sh <nproc> -dec=TRADE -bsz=32 -dr=0.2 -lr=0.001 -le=1 [--dist_backend gloo]
+# -bsz is the batch size of each process
+
+nproc=$1
+shift
+
+torchrun --standalone --nproc_per_node=${nproc} myTrain.py "$@"
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+
+import collections
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+from utils.config import args, EOS_token, UNK_token
+from utils.utils_multiWOZ_DST import collate_fn, batch_to_device, serialize_belief, load_slots, domain_slots, load_langs
+from models.TRADE import TRADE, load_artifact
+
+'''
+python3 serve.py -path=${save_path} --serve_port 8000 --serve_max_batch 32 --serve_max_wait 5
+python3 serve.py --artifact=${artifact} --serve_port 8000 --serve_max_batch 32 --serve_max_wait 5
+
+POST /track {"session": "s1", "system": "...", "user": "..."} adds a turn to the dialogue of the session,
+POST /track {"history": "..."} decodes a whole dialog history (in the " ; " separated format of the
+training data), both answer {"belief": ["domain-slot-value", ...], ...}.
+GET /stats returns the latency percentiles and the throughput counters.
+'''
+
+
+class Request(object):
+    """A dialogue context waiting in the queue of the MicroBatcher, and its answer."""
+    def __init__(self, context, prev_belief):
+        self.context = context
+        self.prev_belief = prev_belief
+        self.done = threading.Event()
+        self.belief = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    """
+    Runs the model on a worker thread. Concurrent requests are grouped into batches of at most `max_batch`,
+    the first request of a batch waiting at most `max_wait` seconds for the others.
+    """
+    def __init__(self, model, slot_temp, device, max_batch, max_wait, tokenizer=None):
+        self.model = model
+        self.slot_temp = slot_temp
+        self.device = device
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.tokenizer = tokenizer
+        self.queue = queue.Queue()
+        self.stats = Stats()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def predict(self, context, prev_belief=()):
+        request = Request(context, list(prev_belief))
+        start = time.perf_counter()
+        self.queue.put(request)
+        request.done.wait()
+        self.stats.add_request(time.perf_counter() - start, request.error is not None)
+        if request.error is not None:
+            raise RuntimeError("inference failed: {!r}".format(request.error))
+        return request.belief
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                batch.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        word2index = self.model.lang.word2index
+        while True:
+            batch = self.next_batch()
+            start = time.perf_counter()
+            try:
+                # the fields collate_fn expects, the index of the request as ID to undo its sort by length
+                items = [{
+                    "ID": i,
+                    "turn_id": 0,
+                    "turn_belief": [],
+                    "gating_label": [0] * len(self.slot_temp),
+                    "context": torch.Tensor([word2index.get(word, UNK_token) for word in request.context.split()]),
+                    "context_plain": request.context,
+                    "turn_uttr_plain": "",
+                    "turn_domain": 0,
+                    "generate_y": [[EOS_token]] * len(self.slot_temp),
+                    "prev_belief": request.prev_belief,
+                } for i, request in enumerate(batch)]
+                data = collate_fn(items, tokenizer=self.tokenizer)
+                with torch.no_grad():
+                    _, gates, point_ids, _ = self.model.encode_and_decode(batch_to_device(data, self.device), False, self.slot_temp)
+                prev_beliefs = data["prev_belief"] if "carry" in self.model.gating_dict else None
+                for i, belief in zip(data["ID"], self.model.predict_beliefs(gates, point_ids, self.slot_temp, prev_beliefs)):
+                    batch[i].belief = belief
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            self.stats.add_batch(len(batch), time.perf_counter() - start)
+            # the values of the vocabulary are few, but not bounded
+            if len(self.model.value_cache) > 100000:
+                self.model.value_cache = {}
+            for request in batch:
+                request.done.set()
+
+
+class Stats(object):
+    """Latency percentiles over the last `window` requests, and throughput counters since the start."""
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.finished = collections.deque(maxlen=window)
+        self.start = time.time()
+        self.requests = self.errors = self.batches = self.batched_requests = 0
+        self.model_time = 0.0
+
+    def add_request(self, latency, error):
+        with self.lock:
+            self.latencies.append(latency)
+            self.finished.append(time.time())
+            self.requests += 1
+            self.errors += int(error)
+
+    def add_batch(self, size, elapsed):
+        with self.lock:
+            self.batches += 1
+            self.batched_requests += size
+            self.model_time += elapsed
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            finished = list(self.finished)
+            uptime = time.time() - self.start
+            summary = {
+                "requests": self.requests,
+                "errors": self.errors,
+                "batches": self.batches,
+                "mean_batch_size": self.batched_requests / self.batches if self.batches else 0.0,
+                "model_time_s": self.model_time,
+                "uptime_s": uptime,
+                "throughput_rps": self.requests / uptime,
+            }
+        if len(finished) > 1 and finished[-1] > finished[0]:
+            summary["recent_throughput_rps"] = (len(finished) - 1) / (finished[-1] - finished[0])
+        if len(latencies):
+            summary["latency_ms"] = dict(("p{}".format(q), float(np.percentile(latencies, q))) for q in (50, 95, 99))
+        return summary
+
+
+class Session(object):
+    """The dialogue of a session, kept as read_langs builds the contexts of the dataset."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.dialog_history = ""
+        self.utterances = []
+        self.belief = []
+        self.turns = 0
+
+    def add_turn(self, system, user):
+        self.dialog_history += system + " ; " + user + " ; "
+        if args["carryover_belief"]:
+            self.utterances += [uttr for uttr in (system, user) if uttr.strip()]
+            turn_window = " ; ".join(self.utterances[-args["context_window"]:]) + " ;"
+            return (serialize_belief(self.belief) + " " + turn_window).strip()
+        return self.dialog_history.strip()
+
+
+class Sessions(object):
+    """The `max_sessions` most recently used sessions."""
+    def __init__(self, max_sessions):
+        self.lock = threading.Lock()
+        self.max_sessions = max_sessions
+        self.sessions = collections.OrderedDict()
+
+    def get(self, session_id):
+        with self.lock:
+            session = self.sessions.pop(session_id, None) or Session()
+            self.sessions[session_id] = session
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+            return session
+
+    def end(self, session_id):
+        with self.lock:
+            return self.sessions.pop(session_id, None) is not None
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        # the headers and the body are two writes, with Nagle's algorithm the body waits for the client's
+        # delayed ACK (not an option of unix sockets)
+        self.disable_nagle_algorithm = isinstance(self.server, HTTPServer)
+        BaseHTTPRequestHandler.setup(self)
+
+    def reply(self, code, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.reply(200, self.server.batcher.stats.summary())
+        else:
+            self.reply(404, {"error": "unknown path " + self.path})
+
+    def do_POST(self):
+        if self.path != "/track":
+            self.reply(404, {"error": "unknown path " + self.path})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError as e:
+            self.reply(400, {"error": "invalid json: {}".format(e)})
+            return
+        try:
+            if "session" in request:
+                session_id = str(request["session"])
+                if request.get("end"):
+                    self.reply(200, {"session": session_id, "ended": self.server.sessions.end(session_id)})
+                    return
+                session = self.server.sessions.get(session_id)
+                # the turns of a session are decoded in order
+                with session.lock:
+                    context = session.add_turn(request.get("system", ""), request.get("user", ""))
+                    session.belief = self.server.batcher.predict(context, session.belief)
+                    session.turns += 1
+                    self.reply(200, {"session": session_id, "turn": session.turns - 1, "belief": session.belief})
+            elif request.get("history", "").strip():
+                belief = self.server.batcher.predict(request["history"].strip(), request.get("prev_belief", []))
+                self.reply(200, {"belief": belief})
+            else:
+                self.reply(400, {"error": "expected a \"session\" with \"system\" and \"user\" utterances, or a \"history\""})
+        except Exception as e:
+            self.reply(500, {"error": repr(e)})
+
+    def log_message(self, format, *log_args):
+        # one line per request would cost more than the model at high load
+        pass
+
+
+class HTTPServer(ThreadingHTTPServer):
+    # the default listen backlog of 5 resets the connections of clients arriving together
+    request_queue_size = 128
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def get_request(self):
+        request, _ = super(UnixHTTPServer, self).get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ("unix", 0)
+
+
+def load_model(device):
+    """
+    The model of --artifact, or of -path with the vocabulary saved next to it, in evaluation mode,
+    and the slots it decodes (those it was trained on with -exceptd or -onlyd).
+    """
+    if args['artifact']:
+        model = load_artifact(args['artifact'], device)
+        model.value_cache = {}
+        return model, model.slot_temp
+    directory = args['path'].split("/")
+    HDD = int(directory[2].split('HDD')[1].split('BSZ')[0])
+    # myTrain.py writes the vocabulary next to the model directory, myTest.py reads it one level above
+    folder_name = os.path.dirname(args['path'].rstrip('/')) + '/'
+    if not os.path.exists(folder_name + ('lang-all.pkl' if args["all_vocab"] else 'lang-train.pkl')):
+        folder_name = args['path'].rsplit('/', 2)[0] + '/'
+    lang, mem_lang = load_langs(folder_name)
+    # the slot embeddings and the gates are sized on all the slots, as in training
+    ALL_SLOTS, gating_dict = load_slots()
+    slot_temp = domain_slots(ALL_SLOTS, "train")
+    model = TRADE(HDD, lang=[lang, mem_lang], path=args['path'], task=args["task"], lr=0, dropout=0,
+                  slots=[ALL_SLOTS, [], slot_temp, slot_temp], gating_dict=gating_dict, t_total=-1, device=device)
+    model.to(device)
+    model.eval()
+    model.value_cache = {}
+    return model, slot_temp
+
+
+def run():
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model, slots = load_model(device)
+    tokenizer = None
+    if args['encoder'] == 'BERT':
+        from transformers.tokenization_bert import BertTokenizer
+        tokenizer = BertTokenizer.from_pretrained(args['bert_model'], do_lower_case=args['do_lower_case'])
+    batcher = MicroBatcher(model, slots, device, args['serve_max_batch'], args['serve_max_wait'] / 1000.0, tokenizer)
+
+    if args['serve_socket']:
+        if os.path.exists(args['serve_socket']):
+            os.remove(args['serve_socket'])
+        server = UnixHTTPServer(args['serve_socket'], Handler)
+        print("Serving on unix socket {}".format(args['serve_socket']))
+    else:
+        server = HTTPServer((args['serve_host'], args['serve_port']), Handler)
+        print("Serving on http://{}:{}".format(args['serve_host'], args['serve_port']))
+    server.batcher = batcher
+    server.sessions = Sessions(args['serve_max_sessions'])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(batcher.stats.summary()))
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,90 @@
+import multiprocessing
+import queue
+import time
+
+import torch
+
+from utils.config import args
+from utils.checkpoint import cpu_snapshot
+
+
+def _eval_worker(jobs, results, parent_args, model_kwargs, dataset, batch_sampler, collate, slot_temp):
+    # the worker is spawned, so it gets its own copy of args: use the one of the training process
+    args.update(parent_args)
+    from models.TRADE import TRADE
+
+    model = TRADE(**model_kwargs)
+    model.to(model_kwargs['device'])
+    dev = torch.utils.data.DataLoader(dataset=dataset, batch_sampler=batch_sampler, collate_fn=collate)
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        epoch, state = job
+        model.encoder.load_state_dict(state['encoder'])
+        model.decoder.load_state_dict(state['decoder'])
+        start = time.time()
+        # matric_best=1e7: the worker never saves, the training process does
+        acc = model.evaluate(dev, 1e7, slot_temp, model_kwargs['device'])
+        results.put((epoch, acc, (time.time() - start) / max(len(dev), 1)))
+
+
+class AsyncEvaluator:
+    """
+    Evaluates snapshots of the model on dev in a separate process while training goes on.
+    At most `max_pending` evaluations can be queued, submit() blocks until one finishes otherwise.
+    Results come back as (epoch, acc, seconds per batch, snapshot) in submission order.
+    """
+    def __init__(self, dev, slot_temp, model_kwargs, max_pending=1):
+        ctx = multiprocessing.get_context('spawn')
+        self.max_pending = max(max_pending, 1)
+        self.pending = {} # epoch -> snapshot of the weights being evaluated
+        self.jobs = ctx.Queue()
+        self.results = ctx.Queue()
+        self.process = ctx.Process(
+            target=_eval_worker,
+            args=(self.jobs, self.results, dict(args), model_kwargs,
+                  dev.dataset, dev.batch_sampler, dev.collate_fn, slot_temp),
+            daemon=True)
+        self.process.start()
+
+    def _get(self, block):
+        while True:
+            try:
+                epoch, acc, eval_time = self.results.get(timeout=1.0) if block else self.results.get_nowait()
+            except queue.Empty:
+                if block and self.process.is_alive():
+                    continue
+                if block:
+                    raise RuntimeError("the evaluation process died with exit code {}".format(self.process.exitcode))
+                return None
+            return epoch, acc, eval_time, self.pending.pop(epoch)
+
+    def submit(self, epoch, model):
+        """Queue an evaluation of the current weights of `model`, returns the results that arrived meanwhile."""
+        finished = self.poll()
+        while len(self.pending) >= self.max_pending:
+            finished.append(self._get(block=True))
+        state = {'encoder': cpu_snapshot(model.encoder.state_dict()), 'decoder': cpu_snapshot(model.decoder.state_dict())}
+        self.pending[epoch] = state
+        self.jobs.put((epoch, state))
+        return finished
+
+    def poll(self):
+        """Results of the evaluations that are done, without waiting."""
+        finished = []
+        while self.pending:
+            result = self._get(block=False)
+            if result is None:
+                break
+            finished.append(result)
+        return finished
+
+    def close(self):
+        """Wait for the pending evaluations and stop the worker, returns their results."""
+        finished = []
+        while self.pending:
+            finished.append(self._get(block=True))
+        self.jobs.put(None)
+        self.process.join()
+        return finished
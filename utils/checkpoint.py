@@ -0,0 +1,106 @@
+import atexit
+import os
+import queue
+import random
+import shutil
+import threading
+
+import numpy as np
+import torch
+
+
+def cpu_snapshot(obj):
+    """Copy of a (nested) state dict with every tensor detached and cloned to CPU."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, cpu_snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_snapshot(v) for v in obj)
+    return obj
+
+
+def get_rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def atomic_save(obj, path):
+    """torch.save to a temporary file then rename, so a preempted job never leaves a truncated file."""
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class CheckpointManager:
+    """
+    Writes checkpoints from a background thread. The state is snapshotted to CPU on the caller's
+    thread, so training can go on while the files are written. Checkpoints saved with a score are
+    rotated to keep only the best `keep_best` ones (0 keeps all of them).
+    """
+    def __init__(self, keep_best=0):
+        self.keep_best = keep_best
+        self.best = [] # (score, directory) of the scored checkpoints still on disk
+        self.error = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+        atexit.register(self.wait)
+
+    def _worker(self):
+        while True:
+            directory, files, score = self.queue.get()
+            try:
+                if not os.path.exists(directory):
+                    os.makedirs(directory)
+                for name, state in files.items():
+                    atomic_save(state, os.path.join(directory, name))
+                if score is not None:
+                    self._rotate(directory, score)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _rotate(self, directory, score):
+        self.best = [b for b in self.best if b[1] != directory] + [(score, directory)]
+        self.best.sort(key=lambda b: b[0], reverse=True)
+        if self.keep_best > 0:
+            for _, old_directory in self.best[self.keep_best:]:
+                shutil.rmtree(old_directory, ignore_errors=True)
+            self.best = self.best[:self.keep_best]
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("writing a checkpoint failed: {}".format(error))
+
+    def save(self, directory, files, score=None):
+        """Queue `files` ({file name: state}) to be written in `directory`."""
+        self._check()
+        self.queue.put((directory, cpu_snapshot(files), score))
+
+    def wait(self):
+        """Block until every queued checkpoint is on disk."""
+        self.queue.join()
+        self._check()
+
+    def state_dict(self):
+        return {'best': list(self.best)}
+
+    def load_state_dict(self, state):
+        self.best = [tuple(b) for b in state['best']]
@@ -1,4 +1,5 @@
 import argparse
+import os
 
 PAD_token = 1
 SOS_token = 3
@@ -31,23 +32,43 @@ parser.add_argument('-imbsamp', '--imbalance_sampler', help='', required=False,
 parser.add_argument('-data_ratio', '--data_ratio', help='', required=False, default=100, type=float)
 parser.add_argument('-um', '--unk_mask', help='mask out input token to UNK', type=int, required=False, default=1)
 parser.add_argument('-bsz', '--batch', help='Batch_size', required=False, type=int)
+parser.add_argument('-btok', '--batch_tokens', help='training batches of variable size holding up to this many padded context words, -bsz is then only used for evaluation', required=False, type=int, default=0)
 
 # Testing Setting
 parser.add_argument('-rundev', '--run_dev_testing', help='', required=False, default=0, type=int)
 parser.add_argument('-viz', '--vizualization', help='vizualization', type=int, required=False, default=0)
 parser.add_argument('-gs', '--genSample', help='Generate Sample', type=int, required=False, default=0)
+parser.add_argument('--prediction_format', help='format of the -gs prediction files: one indented json dict, or json lines (optionally gzipped) written as they are decoded',
+                    choices=['json', 'jsonl', 'jsonl.gz'], required=False, default='json')
+parser.add_argument('--serve_host', help='serve.py: address to listen on', required=False, default='127.0.0.1', type=str)
+parser.add_argument('--serve_port', help='serve.py: port to listen on', required=False, default=8000, type=int)
+parser.add_argument('--serve_socket', help='serve.py: listen on this unix socket instead of a port', required=False, default='', type=str)
+parser.add_argument('--serve_max_batch', help='serve.py: maximum number of requests decoded together', required=False, default=32, type=int)
+parser.add_argument('--serve_max_wait', help='serve.py: milliseconds a request waits for others to fill its batch', required=False, default=5.0, type=float)
+parser.add_argument('--serve_max_sessions', help='serve.py: number of dialogue sessions kept, the least recently used are dropped', required=False, default=10000, type=int)
+parser.add_argument('--artifact', help='model artifact written by export-model.py, loaded by myTest.py and serve.py instead of -path', required=False, default='', type=str)
 parser.add_argument('-evalp', '--evalp', help='evaluation period', required=False, default=1)
+parser.add_argument('--metrics_every', type=int, default=0, help='write throughput and per-phase step times to metrics.jsonl in --log_dir every N batches, 0 disables it')
 parser.add_argument('-an', '--addName', help='An add name for the save folder', required=False, default='')
 parser.add_argument('-eb', '--eval_batch', help='Evaluation Batch_size', required=False, type=int, default=0)
+parser.add_argument('--eval_workers', help='evaluate on the CPU with this number of forked single-threaded processes, each decoding a shard of the dialogues', required=False, default=1, type=int)
+parser.add_argument('--proxy_dev_ratio', help='each epoch only evaluate this fraction of the dev dialogues (stratified by domains) for early stopping, 0 evaluates all of them', required=False, default=0, type=float)
+parser.add_argument('--full_eval_every', help='with --proxy_dev_ratio, evaluate the full dev set every N evaluations, or when the proxy improves beyond its confidence interval', required=False, default=5, type=int)
+parser.add_argument('--async_eval', type=str2bool, default=False, help='evaluate on dev in a separate process while training continues')
+parser.add_argument('--max_pending_evals', type=int, default=1, help='maximum number of queued dev evaluations with --async_eval')
 
 # Model architecture
 parser.add_argument('-gate', '--use_gate', help='', required=False, default=1, type=int)
 parser.add_argument('-le', '--load_embedding', help='', required=False, default=0, type=int)
 parser.add_argument('-femb', '--fix_embedding', help='', required=False, default=0, type=int)
 parser.add_argument('-paral', '--parallel_decode', help='', required=False, default=1, type=int)
+parser.add_argument('--grad_checkpoint', help='recompute the activations of the BERT layers and/or of the decoding steps in backward instead of keeping them, to save memory', required=False, default='none', choices=['none', 'bert', 'decoder', 'all'])
+parser.add_argument('--none_slot_ratio', help='training only decodes the slots with a value plus this fraction of the "none" ones, -1 decodes all of them', required=False, default=-1, type=float)
 parser.add_argument('--cell_type', help='cell type to use for RNN models', required=False, default='GRU', choices=['LSTM', 'GRU'])
 parser.add_argument('--pretrain_domain_embeddings', help='', required=False, default=False, action='store_true')
 parser.add_argument('--merge_embed', help='merging strategy to combine slot and domain embeddings', required=False, default='sum', choices=['sum', 'mean', 'concat'])
+parser.add_argument('-cob', '--carryover_belief', help='condition on the previous belief state and the last utterances instead of the full dialog history', required=False, default=0, type=int)
+parser.add_argument('-cw', '--context_window', help='number of most recent utterances kept in the context when using --carryover_belief', required=False, default=4, type=int)
 
 # for TPRNN
 parser.add_argument("--nSymbols", default=50, type=int, help="# of symbols")
@@ -72,10 +93,20 @@ parser.add_argument('--max_epochs', help='maximum number of epochs', required=Fa
 parser.add_argument('-wp', "--warmup_proportion", default=0.1, type=float, help="Proportion of training to perform linear learning rate warmup for")
 
 # Unseen Domain Setting
+parser.add_argument('--cl_method', help='continual_train.py: regularizer against forgetting the other domains', type=str, required=False,
+                    default='naive', choices=['naive', 'ewc', 'gem'])
 parser.add_argument('-l_ewc', '--lambda_ewc', help='regularization term for EWC loss', type=float, required=False,
                     default=0.01)
 parser.add_argument('-fisher_sample', '--fisher_sample', help='number of sample used to approximate fisher mat',
                     type=int, required=False, default=0)
+parser.add_argument('-fisher_probes', '--fisher_probes', help='random sign probes per batch to estimate the fisher diagonal instead of one backward pass per example (0, exact)',
+                    type=int, required=False, default=0)
+parser.add_argument('-gem_refresh', '--gem_refresh', help='steps between two refreshes of the GEM reference gradient of the old domains',
+                    type=int, required=False, default=10)
+parser.add_argument('--replay_budget', help='number of examples of the old domains kept for replay when fine-tuning, 0 for none',
+                    type=int, required=False, default=0)
+parser.add_argument('--replay_ratio', help='fraction of the examples of each fine-tuning step drawn from the replay buffer',
+                    type=float, required=False, default=0.25)
 parser.add_argument("--all_model", action="store_true")
 parser.add_argument("--domain_as_task", action="store_true")
 parser.add_argument('--run_except_4d', help='', required=False, default=1, type=int)
@@ -83,22 +114,37 @@ parser.add_argument("--strict_domain", action="store_true")
 parser.add_argument('-exceptd', '--except_domain', help='', required=False, default="", type=str)
 parser.add_argument('--except_domain_dev', help='like -exceptd, but only for dev set', required=False, default="", type=str)
 parser.add_argument('-onlyd', '--only_domain', help='', required=False, default="", type=str)
+parser.add_argument('--eval_slices', help='myTest.py: also report the test metrics by domain (as -onlyd), turn and number of slots, from the same predictions',
+                    required=False, default=0, type=int)
 
 # extra parameters
 parser.add_argument('--seed', help='seed for random operations', required=False, default="123", type=int)
 parser.add_argument('--log_dir', help='Save logs here', required=False, default="./log", type=str)
 parser.add_argument('--data_dir', help='Load data from here', required=False, default="./data", type=str)
+parser.add_argument('--data_cache', help='pickle of the preprocessed training data shared by several runs, built if missing', required=False, default=None, type=str)
+parser.add_argument('--preprocess_only', type=str2bool, default=False, help='only build --data_cache and exit')
 parser.add_argument("--delete_ok", type=str2bool, default=False, help='whether to delete the result directory if it already exists')
+parser.add_argument('--resume', type=str2bool, default=False, help='resume training from the checkpoint in --log_dir')
+parser.add_argument('--checkpoint_every', type=int, default=0, help='also save the resume checkpoint every N training batches, 0 saves it only at the end of each epoch')
+parser.add_argument('--keep_best', type=int, default=0, help='number of best saved models to keep on disk, 0 keeps all of them')
 
 # bert parameters
 parser.add_argument("--bert_model", default=None, type=str, help="Bert pre-trained model selected")
 parser.add_argument("--do_lower_case", type=str2bool, default=False, help="Set this flag if you are using an uncased model.")
 parser.add_argument("--num_bert_layers", type=int, default=12, help='num_bert_layers to use in our model')
 parser.add_argument("--encoder", type=str, default='RNN', choices=['RNN', 'BERT', 'TPRNN'], help='type of encoder to use for context')
-parser.add_argument("--local_rank", type=int, default=-1, help="local_rank for distributed training on gpus")
+parser.add_argument("--local_rank", type=int, default=-1, help="local_rank for distributed training, set from LOCAL_RANK when started with torchrun")
+parser.add_argument("--dist_backend", type=str, default=None, choices=['gloo', 'nccl'], help='torch.distributed backend, defaults to nccl on gpus and gloo on cpus')
 
 parser.add_argument('-mcl', "--max_context_length", type=int, default=-1, help="maximum length of context should not be larger than 512 when using BERT as encoder")
 
+# distillation parameters
+parser.add_argument("--distill_teacher", type=str, default=None, help='path of a trained BERT-encoder TRADE model used as teacher')
+parser.add_argument("--distill_topk", type=int, default=10, help='number of teacher value probabilities cached per decoding step')
+parser.add_argument("--distill_alpha", type=float, default=0.5, help='weight of the teacher soft targets in the training loss')
+parser.add_argument("--distill_temperature", type=float, default=1.0, help='softmax temperature of the teacher and student distributions of both the gates and the values, the soft losses are scaled by its square')
+parser.add_argument("--distill_cache", type=str, default=None, help='file caching the teacher outputs, defaults to a file in the teacher directory')
+
 args = vars(parser.parse_args())
 
 if args["load_embedding"]:
@@ -111,14 +157,23 @@ if args["except_domain"] != "":
 if args["only_domain"] != "":
     args["addName"] += "Only" + args["only_domain"]
 
-args['batch'] = int(args['batch'] / args['gradient_accumulation_steps'])
+# torchrun passes the rank of the process in the environment
+if 'LOCAL_RANK' in os.environ:
+    args['local_rank'] = int(os.environ['LOCAL_RANK'])
+
+# -bsz is optional for testing and serving, myTrain.py requires it
+if args['batch']:
+    args['batch'] = int(args['batch'] / args['gradient_accumulation_steps'])
+
+# the BERT tokenizer is also needed to run a BERT teacher when distilling
+use_bert = args['encoder'] == 'BERT' or args['distill_teacher'] is not None
 
-if args['encoder'] == 'BERT' and 'uncased' in args['bert_model'] and not args['do_lower_case']:
+if use_bert and 'uncased' in args['bert_model'] and not args['do_lower_case']:
     print('do_lower_case should be True if uncased bert models are used')
     print('changing do_lower_case from False to True')
     args['do_lower_case'] = True
 
-if args['encoder'] == 'BERT':
+if use_bert:
     args['max_context_length'] = 512 - 30
 
 
@@ -0,0 +1,286 @@
+import json
+import os
+
+import numpy as np
+import torch
+
+from utils.utils_multiWOZ_DST import batch_to_device
+
+
+def per_example_value_loss(model, data, slot_temp):
+    """
+    Value (pointer-generator) loss of each example of a batch, teacher-forced on the gold values:
+    the loss masked_cross_entropy_for_value gives for a batch of that example alone.
+    The model is in training mode, so with --none_slot_ratio only the rows training decodes
+    (model.decode_rows, see sample_decode_rows) count, as in compute_loss.
+    """
+    all_point_outputs, _, _, _ = model.encode_and_decode(data, True, slot_temp)
+    y_lengths = data["y_lengths"]
+    if "carry" in model.gating_dict:
+        y_lengths = y_lengths * (data["gating_label"] != model.gating_dict["carry"]).long()
+    generate_y = data["generate_y"]
+    value_outputs = all_point_outputs.transpose(0, 1)
+    if model.decode_rows is not None:
+        # one "slot" per decoded row, b' * 1 * m * |v|
+        value_outputs = all_point_outputs.unsqueeze(1)
+        y_lengths, generate_y = model.select_rows(y_lengths), model.select_rows(generate_y)
+    probs = torch.gather(value_outputs, -1, generate_y.unsqueeze(-1)).squeeze(-1) # b * |s| * m
+    losses = -torch.log(probs.clamp(min=1e-12))
+    mask = (torch.arange(losses.size(2), device=losses.device) < y_lengths.unsqueeze(-1)).float()
+    total, count = (losses * mask).sum((1, 2)), mask.sum((1, 2))
+    if model.decode_rows is not None:
+        # back to the examples of the rows, row = slot * batch_size + example
+        batch_size = data["generate_y"].size(0)
+        example = model.decode_rows % batch_size
+        total = total.new_zeros(batch_size).index_add(0, example, total)
+        count = count.new_zeros(batch_size).index_add(0, example, count)
+    return total / count.clamp(min=1)
+
+
+def compute_fisher(model, loader, slot_temp, device, max_samples=0, probes=0, seed=0):
+    """
+    Diagonal of the empirical Fisher information of the value loss: the mean over the examples of `loader`
+    (at most max_samples, 0 for all) of their squared gradients. Returns it with a copy of the current
+    parameters, as dicts of tensors.
+    probes=0 is exact: the examples go through the model one at a time, in an order drawn from `seed`,
+    each with its own forward and backward pass (the backward of each example of a batched forward would
+    walk the whole batch's graph every time). With probes=k the batches of `loader` take k backward
+    passes instead, each of sum_i s_i * loss_i with random signs s_i = +-1: the cross terms of its square
+    cancel in expectation, so it estimates sum_i grad_i^2 without bias, with more variance.
+    """
+    named = [(n, p) for n, p in model.named_parameters() if p.requires_grad]
+    params = [p for _, p in named]
+    fisher = {n: torch.zeros_like(p) for n, p in named}
+    signs = torch.Generator(device=device)
+    signs.manual_seed(seed)
+    if probes == 0:
+        order = torch.Generator()
+        order.manual_seed(seed)
+        loader = torch.utils.data.DataLoader(dataset=loader.dataset, batch_size=1, shuffle=True, generator=order,
+                                             collate_fn=loader.collate_fn)
+    seen = 0
+    model.encoder.train(True)
+    model.decoder.train(True)
+    for data in loader:
+        losses = per_example_value_loss(model, batch_to_device(data, device), slot_temp)
+        if max_samples > 0:
+            losses = losses[:max_samples - seen]
+        n = losses.size(0)
+        if probes > 0:
+            backward = [(torch.randint(0, 2, (n,), device=losses.device, generator=signs) * 2 - 1) * losses
+                        for _ in range(probes)]
+        else:
+            backward = losses
+        for i, loss in enumerate(backward):
+            grads = torch.autograd.grad(loss.sum(), params, retain_graph=i < len(backward) - 1, allow_unused=True)
+            for (name, _), g in zip(named, grads):
+                if g is not None:
+                    fisher[name] += g.pow(2)
+        seen += n
+        print("Fisher information: {} examples".format(seen), end='\r', flush=True)
+        if max_samples > 0 and seen >= max_samples:
+            break
+    print()
+    for name in fisher:
+        fisher[name] /= max(seen, 1) * max(probes, 1)
+    optpar = {n: p.detach().clone() for n, p in named}
+    return fisher, optpar
+
+
+def save_fisher(directory, fisher, optpar):
+    """
+    Writes the Fisher diagonal and the parameters as flat float32 arrays (fisher.npy, optpar.npy), one
+    parameter after the other, with their names, offsets and shapes in index.json.
+    """
+    os.makedirs(directory, exist_ok=True)
+    index, offset = [], 0
+    for name, tensor in fisher.items():
+        index.append({'name': name, 'offset': offset, 'shape': list(tensor.size())})
+        offset += tensor.numel()
+    for filename, tensors in (('fisher.npy', fisher), ('optpar.npy', optpar)):
+        flat = np.lib.format.open_memmap(os.path.join(directory, filename), mode='w+', dtype=np.float32, shape=(offset,))
+        for entry in index:
+            flat[entry['offset']:entry['offset'] + int(np.prod(entry['shape']))] = \
+                tensors[entry['name']].detach().float().cpu().reshape(-1).numpy()
+        flat.flush()
+        del flat
+    with open(os.path.join(directory, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+
+def load_fisher(directory, device):
+    """Reads save_fisher() output through memory maps, returns the Fisher diagonal and the parameters on `device`."""
+    with open(os.path.join(directory, 'index.json')) as f:
+        index = json.load(f)
+    result = []
+    for filename in ('fisher.npy', 'optpar.npy'):
+        flat = np.load(os.path.join(directory, filename), mmap_mode='r')
+        tensors = {}
+        for entry in index:
+            values = flat[entry['offset']:entry['offset'] + int(np.prod(entry['shape']))]
+            tensors[entry['name']] = torch.tensor(values).view(*entry['shape']).to(device)
+        result.append(tensors)
+    return result[0], result[1]
+
+
+def ewc_penalty(model, fisher, optpar, lambda_ewc):
+    """lambda_ewc * sum of fisher * (p - optpar)^2 over the parameters, keeping them close to the old task's."""
+    penalty = 0
+    for name, p in model.named_parameters():
+        if name in fisher:
+            penalty = penalty + (fisher[name] * (p - optpar[name]).pow(2)).sum()
+    return lambda_ewc * penalty
+
+
+class FlatGradients(object):
+    """
+    The gradients of `params` as views into one flat buffer, `flat`, so they can be read, projected and
+    written back as a single vector. Backward passes accumulate into the views in place.
+    """
+    def __init__(self, params):
+        self.params = [p for p in params if p.requires_grad]
+        self.offsets = [0]
+        for p in self.params:
+            self.offsets.append(self.offsets[-1] + p.numel())
+        self.flat = torch.zeros(self.offsets[-1], dtype=self.params[0].dtype, device=self.params[0].device)
+        self.zero()
+
+    def zero(self):
+        """Zeroes the buffer and points the gradients back at it (zero_grad() may have set them to None)."""
+        self.flat.zero_()
+        for p, beg, end in zip(self.params, self.offsets, self.offsets[1:]):
+            p.grad = self.flat[beg:end].view_as(p)
+
+
+def project2cone2(gradient, memories, margin=0.5, eps=1e-3, max_iter=100, tol=1e-6):
+    """
+    GEM projection (https://github.com/facebookresearch/GradientEpisodicMemory): overwrites the p-vector
+    `gradient` with the closest gradient having a non-negative dot product with each row of the
+    t * p `memories`. The dual QP min 1/2 v'Pv + q'v s.t. v >= margin, P = MM' + eps*I, q = Mg, has only t
+    variables and is solved by coordinate descent, exactly in one pass when t == 1.
+    """
+    P = torch.mm(memories, memories.t()).double()
+    P = 0.5 * (P + P.t()) + torch.eye(P.size(0), dtype=P.dtype, device=P.device) * eps
+    q = torch.mv(memories, gradient).double()
+    v = torch.full_like(q, margin)
+    for _ in range(max_iter):
+        change = 0.0
+        for i in range(v.size(0)):
+            new = torch.clamp(v[i] - (torch.dot(P[i], v) + q[i]) / P[i, i], min=margin)
+            change = max(change, abs((new - v[i]).item()))
+            v[i] = new
+        if change < tol:
+            break
+    gradient.add_(torch.mv(memories.t(), v.to(memories.dtype)))
+
+
+def cycle(loader):
+    """Batches of `loader`, epoch after epoch."""
+    while True:
+        for data in loader:
+            yield data
+
+
+class Regularizer(object):
+    """
+    Naive fine-tuning: the hooks called by the training loop of myTrain.run, which subclasses override to
+    add a penalty to the loss (EWC) or to change the gradients before the optimizer step (GEM).
+    With a replay buffer, each step also learns from `replay_size` examples of the old domains, which
+    weigh `replay_ratio` of the loss.
+    """
+    def __init__(self, replay=None, replay_size=0, replay_ratio=0.0, collate=None):
+        self.replay = replay
+        self.replay_size = replay_size
+        self.replay_ratio = replay_ratio
+        self.collate = collate
+
+    def setup(self, core, device):
+        """Called once the model is built, before training."""
+        self.device = device
+
+    def zero_grad(self, core):
+        core.optimizer.zero_grad()
+
+    def before_forward(self, core, step):
+        pass
+
+    def loss(self, core, loss):
+        if self.replay is None:
+            return loss
+        # the replayed examples are labelled for the slots of the old domains, decoded separately
+        replayed = self.replay.sample(self.replay_size, self.collate)
+        # not through core(), whose running losses are those of the fine-tuning batches
+        loss_replay = core.training_loss(batch_to_device(replayed, self.device), self.replay.slots)
+        return (1 - self.replay_ratio) * loss + self.replay_ratio * loss_replay
+
+    def before_step(self, core):
+        pass
+
+
+class EWC(Regularizer):
+    """
+    Elastic weight consolidation: lambda_ewc * sum of fisher * (p - p_old)^2 is added to the loss. The Fisher
+    information is read from `directory`, or estimated on `loader` (the old domains) and saved there.
+    """
+    def __init__(self, directory, loader, slot_temp, lambda_ewc, fisher_sample=0, probes=0, seed=0, **kwargs):
+        super(EWC, self).__init__(**kwargs)
+        self.directory = directory
+        self.loader = loader
+        self.slot_temp = slot_temp
+        self.lambda_ewc = lambda_ewc
+        self.fisher_sample = fisher_sample
+        self.probes = probes
+        self.seed = seed
+
+    def setup(self, core, device):
+        super(EWC, self).setup(core, device)
+        if os.path.isfile(os.path.join(self.directory, 'index.json')):
+            print("Load Fisher Matrix " + self.directory)
+            self.fisher, self.optpar = load_fisher(self.directory, device)
+        else:
+            print("Computing Fisher Matrix ")
+            self.fisher, self.optpar = compute_fisher(core, self.loader, self.slot_temp, device, self.fisher_sample, self.probes, self.seed)
+            print("Saving Fisher Matrix in ", self.directory)
+            save_fisher(self.directory, self.fisher, self.optpar)
+
+    def loss(self, core, loss):
+        return super(EWC, self).loss(core, loss) + ewc_penalty(core, self.fisher, self.optpar, self.lambda_ewc)
+
+
+class GEM(Regularizer):
+    """
+    Gradient episodic memory: when the gradient of a step goes against the gradient of a batch of the old
+    domains (`loader`), refreshed every `refresh` steps, it is projected so that it does not.
+    The gradients live in a FlatGradients buffer, so the optimizer steps on zeroed, not missing, gradients.
+    """
+    def __init__(self, loader, slot_temp, margin, refresh=1, **kwargs):
+        super(GEM, self).__init__(**kwargs)
+        self.loader = loader
+        self.slot_temp = slot_temp
+        self.margin = margin
+        self.refresh = refresh
+
+    def setup(self, core, device):
+        super(GEM, self).setup(core, device)
+        self.flat_grads = FlatGradients(core.parameters())
+        # reference gradient of the old domains
+        self.memories = torch.zeros(1, self.flat_grads.flat.numel(), dtype=self.flat_grads.flat.dtype, device=device)
+        self.batches = cycle(self.loader)
+        self.steps = 0
+
+    def zero_grad(self, core):
+        self.flat_grads.zero()
+
+    def before_forward(self, core, step):
+        if self.steps % self.refresh == 0:
+            with core.timer.phase('gem_refresh'):
+                self.flat_grads.zero()
+                core.training_loss(batch_to_device(next(self.batches), self.device), self.slot_temp).backward()
+                self.memories[0].copy_(self.flat_grads.flat)
+                self.flat_grads.zero()
+        self.steps += 1
+
+    def before_step(self, core):
+        # the gradients are views of flat_grads.flat, projecting it in place updates them
+        if (torch.mv(self.memories, self.flat_grads.flat) < 0).any():
+            project2cone2(self.flat_grads.flat, self.memories, self.margin)
@@ -0,0 +1,112 @@
+import os
+import time
+from functools import partial
+
+import torch
+from transformers.tokenization_bert import BertTokenizer
+
+from utils.config import args
+from utils.utils_multiWOZ_DST import batch_to_device, collate_fn
+
+
+def load_teacher(path, lang, slots, gating_dict, device, nb_train_vocab=0):
+    """
+    Load a trained BERT-encoder TRADE model saved by save_model, the hidden size is read from the path.
+    """
+    from models.TRADE import TRADE
+
+    hidden_size = int(os.path.basename(os.path.normpath(path)).split('HDD')[1].split('BSZ')[0])
+    teacher = TRADE(
+        hidden_size,
+        lang=lang,
+        path=path,
+        task=args['task'],
+        lr=0,
+        dropout=0,
+        slots=slots,
+        gating_dict=gating_dict,
+        t_total=-1,
+        device=device,
+        nb_train_vocab=nb_train_vocab,
+        encoder_type='BERT')
+    teacher.to(device)
+    return teacher
+
+
+def teacher_loader(loader, batch_size=None):
+    """
+    The examples of `loader` with the BERT features of the teacher, which the loaders of the student
+    do not compute: batched as `loader`, or in order by `batch_size` examples.
+    """
+    tokenizer = BertTokenizer.from_pretrained(args['bert_model'], do_lower_case=args['do_lower_case'])
+    collate = partial(collate_fn, tokenizer=tokenizer)
+    if batch_size:
+        return torch.utils.data.DataLoader(dataset=loader.dataset, batch_size=batch_size, collate_fn=collate)
+    return torch.utils.data.DataLoader(dataset=loader.dataset, batch_sampler=loader.batch_sampler, collate_fn=collate)
+
+
+def timed_evaluate(model, dev, slot_temp, device):
+    """
+    Joint accuracy on dev and seconds per batch, used to compare the teacher and the student.
+    """
+    start = time.time()
+    acc = model.evaluate(dev, 1e7, slot_temp, device)
+    return acc, (time.time() - start) / max(len(dev), 1)
+
+
+class TeacherCache:
+    """
+    Soft targets of the teacher for every training turn, keyed by (dialogue ID, turn id).
+    Each entry keeps the gate logits [|s|, nb_gate] and the top-k value probabilities and
+    vocabulary ids [|s|, m, k] where m is the longest gold value of the turn.
+    """
+    def __init__(self, topk, entries=None):
+        self.topk = topk
+        self.entries = entries if entries is not None else {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def build(cls, teacher, train, slot_temp, device, topk):
+        cache = cls(topk)
+        print("Caching teacher outputs on {} batches".format(len(train)))
+        for data in train:
+            batch = batch_to_device(data, device)
+            gates, value_prob, value_idx = teacher.soft_targets(batch, slot_temp, topk)
+            max_len = data['y_lengths'].max(dim=1)[0]
+            for bi in range(len(data['ID'])):
+                m = int(max_len[bi])
+                cache.entries[(data['ID'][bi], data['turn_id'][bi])] = (
+                    gates[bi].half().cpu(),
+                    value_prob[bi, :, :m].half().cpu(),
+                    value_idx[bi, :, :m].int().cpu())
+        return cache
+
+    def save(self, path):
+        torch.save({'topk': self.topk, 'entries': self.entries}, path)
+
+    @classmethod
+    def load(cls, path):
+        saved = torch.load(path)
+        return cls(saved['topk'], saved['entries'])
+
+    def batch(self, data, device):
+        """
+        Teacher targets of a batch, padded to the decoding length of the batch.
+        """
+        bsz = len(data['ID'])
+        nb_slots, max_len = data['generate_y'].size(1), data['generate_y'].size(2)
+        entries = [self.entries[(data['ID'][bi], data['turn_id'][bi])] for bi in range(bsz)]
+        teacher_gate = torch.stack([e[0] for e in entries]).float()
+        teacher_value_prob = torch.zeros(bsz, nb_slots, max_len, self.topk)
+        teacher_value_idx = torch.zeros(bsz, nb_slots, max_len, self.topk, dtype=torch.long)
+        for bi, (_, prob, idx) in enumerate(entries):
+            m = min(prob.size(1), max_len)
+            teacher_value_prob[bi, :, :m] = prob[:, :m].float()
+            teacher_value_idx[bi, :, :m] = idx[:, :m].long()
+        return {
+            'teacher_gate': teacher_gate.to(device),
+            'teacher_value_prob': teacher_value_prob.to(device),
+            'teacher_value_idx': teacher_value_idx.to(device),
+        }
@@ -1,3 +1,9 @@
+import gzip
+import json
+import math
+import os
+
+
 def remove_none_slots(belief):
     for slot_tuple in belief:
         domain, slot_name, slot_value = slot_tuple.split('-')
@@ -45,3 +51,118 @@ def get_slot_names(belief):
 
 def get_name_accuracy(annotation, prediction):
     return float(set(get_slot_names(annotation)) == set(get_slot_names(prediction)))
+
+
+PREDICTION_FORMATS = ('json', 'jsonl', 'jsonl.gz')
+
+
+def open_predictions(path, mode='r'):
+    """Text file of predictions, gzip-compressed if the path ends with .gz."""
+    if path.endswith('.gz'):
+        # the fastest level, written during evaluation, still ~10x smaller than the text
+        return gzip.open(path, mode + 't', encoding='utf-8', compresslevel=1)
+    return open(path, mode, encoding='utf-8')
+
+
+class PredictionWriter(object):
+    """
+    Writes predictions as they are decoded, one JSON object per line and turn:
+    {"dialogue": ID, "turn": turn id, "turn_belief": [...], "pred_bs_ptr": [...]}.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open_predictions(path, 'w')
+
+    def write(self, dialogue, turn, prediction):
+        row = {"dialogue": dialogue, "turn": turn}
+        row.update(prediction)
+        self.file.write(json.dumps(row, separators=(',', ':')) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+class BeliefMetrics(object):
+    """
+    The metrics of TRADE.evaluate_metrics on the `from_which` beliefs, accumulated one turn at a time so
+    that evaluating does not need to keep the predictions: joint accuracy, slot (turn) accuracy, joint F1,
+    and the number of turns and of correct turns of each dialogue for joint_acc_interval.
+    """
+    def __init__(self, model, slot_temp, from_which="pred_bs_ptr"):
+        self.model = model
+        self.slot_temp = slot_temp
+        self.from_which = from_which
+        self.total, self.turn_acc, self.joint_acc, self.F1_pred, self.F1_count = 0, 0, 0, 0, 0
+        # dialogue ID -> [correct turns, turns]
+        self.dialogues = {}
+
+    def add(self, dialogue, prediction):
+        gold, pred = set(prediction["turn_belief"]), set(prediction[self.from_which])
+        correct = gold == pred
+        self.joint_acc += correct
+        self.total += 1
+        self.turn_acc += self.model.compute_acc(gold, pred, self.slot_temp)
+        F1, _, _, count = self.model.compute_prf(gold, pred)
+        self.F1_pred += F1
+        self.F1_count += count
+        counts = self.dialogues.setdefault(dialogue, [0, 0])
+        counts[0] += correct
+        counts[1] += 1
+
+    def scores(self):
+        """joint accuracy, joint F1 and slot accuracy, as evaluate_metrics returns them."""
+        joint_acc_score = self.joint_acc / float(self.total) if self.total != 0 else 0
+        turn_acc_score = self.turn_acc / float(self.total) if self.total != 0 else 0
+        F1_score = self.F1_pred / float(self.F1_count) if self.F1_count != 0 else 0
+        return joint_acc_score, F1_score, turn_acc_score
+
+    def joint_acc_interval(self, z=1.96):
+        """
+        Joint accuracy and its confidence interval (95% by default). The turns of a dialogue are not
+        independent, so the standard error is the cluster-robust one with dialogues as clusters.
+        """
+        n = len(self.dialogues)
+        turns = float(sum(t for _, t in self.dialogues.values()))
+        joint_acc = sum(c for c, _ in self.dialogues.values()) / turns if n > 0 else 0.0
+        if n < 2:
+            return joint_acc, 0.0, 1.0
+        se = math.sqrt(n / (n - 1.0) * sum((c - joint_acc * t) ** 2 for c, t in self.dialogues.values())) / turns
+        return joint_acc, max(joint_acc - z * se, 0.0), min(joint_acc + z * se, 1.0)
+
+
+def save_predictions(all_prediction, path):
+    """Writes the {dialogue: {turn: prediction}} dict of TRADE.evaluate in the format of the path's extension."""
+    if path.endswith('.json'):
+        with open(path, 'w') as f:
+            json.dump(all_prediction, f, indent=4)
+        return
+    writer = PredictionWriter(path)
+    for dialogue, turns in all_prediction.items():
+        for turn, prediction in turns.items():
+            writer.write(dialogue, turn, prediction)
+    writer.close()
+
+
+def iter_predictions(path):
+    """
+    (dialogue, turn id, {"turn_belief": [...], "pred_bs_ptr": [...]}) for each turn of a prediction file.
+    .jsonl and .jsonl.gz files are read one line at a time, .json files are loaded whole.
+    """
+    if path.endswith('.json'):
+        with open(path) as f:
+            for dialogue, turns in json.load(f).items():
+                for turn, prediction in turns.items():
+                    yield dialogue, int(turn), prediction
+        return
+    with open_predictions(path) as f:
+        for line in f:
+            row = json.loads(line)
+            yield row.pop("dialogue"), row.pop("turn"), row
+
+
+def find_predictions(prefix):
+    """The prediction file prefix + .jsonl.gz, .jsonl or .json, the first that exists."""
+    for extension in reversed(PREDICTION_FORMATS):
+        if os.path.exists(prefix + '.' + extension):
+            return prefix + '.' + extension
+    raise FileNotFoundError(prefix + '.json')
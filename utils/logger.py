@@ -1,71 +1,95 @@
-# Code referenced from https://gist.github.com/gyglim/1f8dfb1b5c82627ae3efcfbbadb9f514
-import tensorflow as tf
-import numpy as np
-import scipy.misc 
-try:
-    from StringIO import StringIO  # Python 2.7
-except ImportError:
-    from io import BytesIO         # Python 3.x
+import json
+import os
+import resource
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
 
 
 class Logger(object):
-    
-    def __init__(self, log_dir):
-        """Create a summary writer logging to log_dir."""
-        self.writer = tf.summary.FileWriter(log_dir)
+
+    def __init__(self, log_dir, filename='metrics.jsonl'):
+        """Append metrics as one JSON object per line to log_dir/filename."""
+        self.path = os.path.join(log_dir, filename)
+        self.writer = open(self.path, 'a')
+
+    def log(self, step, **metrics):
+        """Log a dict of metrics for a training step."""
+        record = OrderedDict([('time', time.time()), ('step', step)])
+        record.update(metrics)
+        self.writer.write(json.dumps(record) + '\n')
+        self.writer.flush()
 
     def scalar_summary(self, tag, value, step):
         """Log a scalar variable."""
-        summary = tf.Summary(value=[tf.Summary.Value(tag=tag, simple_value=value)])
-        self.writer.add_summary(summary, step)
+        self.log(step, **{tag: value})
 
-    def image_summary(self, tag, images, step):
-        """Log a list of images."""
+    def close(self):
+        self.writer.close()
 
-        img_summaries = []
-        for i, img in enumerate(images):
-            # Write the image to a string
-            try:
-                s = StringIO()
-            except:
-                s = BytesIO()
-            scipy.misc.toimage(img).save(s, format="png")
 
-            # Create an Image object
-            img_sum = tf.Summary.Image(encoded_image_string=s.getvalue(),
-                                       height=img.shape[0],
-                                       width=img.shape[1])
-            # Create a Summary value
-            img_summaries.append(tf.Summary.Value(tag='%s/%d' % (tag, i), image=img_sum))
+class PhaseTimer(object):
+    """
+    Accumulates the wall time spent in each phase of the training step, plus the number
+    of examples and context tokens processed, between two calls to summary(), which also
+    reports the peak memory.
+    With synchronize=True the CUDA queue is flushed around each phase so GPU time is
+    attributed to the right phase, at the price of some overlap.
+    """
 
-        # Create and write Summary
-        summary = tf.Summary(value=img_summaries)
-        self.writer.add_summary(summary, step)
-        
-    def histo_summary(self, tag, values, step, bins=1000):
-        """Log a histogram of the tensor of values."""
+    def __init__(self, enabled=True, synchronize=False):
+        self.enabled = enabled
+        self.synchronize = synchronize
+        self.reset()
 
-        # Create a histogram using numpy
-        counts, bin_edges = np.histogram(values, bins=bins)
+    def reset(self):
+        self.totals = OrderedDict()
+        self.steps, self.examples, self.tokens = 0, 0, 0
+        self.start = time.perf_counter()
+        if self.synchronize:
+            torch.cuda.reset_peak_memory_stats()
+            self.cuda_allocs = torch.cuda.memory_stats().get('allocation.all.allocated', 0)
 
-        # Fill the fields of the histogram proto
-        hist = tf.HistogramProto()
-        hist.min = float(np.min(values))
-        hist.max = float(np.max(values))
-        hist.num = int(np.prod(values.shape))
-        hist.sum = float(np.sum(values))
-        hist.sum_squares = float(np.sum(values**2))
+    def add(self, name, seconds):
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
 
-        # Drop the start of the first bin
-        bin_edges = bin_edges[1:]
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        if self.synchronize:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.synchronize:
+                torch.cuda.synchronize()
+            self.add(name, time.perf_counter() - start)
 
-        # Add bin edges and counts
-        for edge in bin_edges:
-            hist.bucket_limit.append(edge)
-        for c in counts:
-            hist.bucket.append(c)
+    def count(self, examples, tokens):
+        self.steps += 1
+        self.examples += examples
+        self.tokens += tokens
 
-        # Create and write Summary
-        summary = tf.Summary(value=[tf.Summary.Value(tag=tag, histo=hist)])
-        self.writer.add_summary(summary, step)
-        self.writer.flush()
\ No newline at end of file
+    def summary(self):
+        """Throughput and milliseconds per step of each phase since the last summary, then reset."""
+        elapsed = time.perf_counter() - self.start
+        steps = max(self.steps, 1)
+        metrics = OrderedDict()
+        metrics['examples_per_sec'] = self.examples / elapsed
+        metrics['tokens_per_sec'] = self.tokens / elapsed
+        metrics['ms_per_step'] = 1000.0 * elapsed / steps
+        for name, seconds in self.totals.items():
+            metrics['ms_' + name] = 1000.0 * seconds / steps
+        metrics['ms_other'] = 1000.0 * (elapsed - sum(self.totals.values())) / steps
+        # ru_maxrss is in kilobytes on Linux and never goes down, the CUDA peak is since the last summary
+        metrics['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        if self.synchronize:
+            metrics['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 2.0 ** 20
+            metrics['cuda_allocs_per_step'] = (torch.cuda.memory_stats().get('allocation.all.allocated', 0) - self.cuda_allocs) / steps
+        self.reset()
+        return metrics
@@ -5,14 +5,8 @@ import torch.nn as nn
 def sequence_mask(sequence_length, max_len=None):
     if max_len is None:
         max_len = sequence_length.data.max()
-    batch_size = sequence_length.size(0)
-    seq_range = torch.arange(0, max_len).long()
-    seq_range_expand = seq_range.unsqueeze(0).expand(batch_size, max_len)
-    if sequence_length.is_cuda:
-        seq_range_expand = seq_range_expand.cuda()
-    seq_length_expand = (sequence_length.unsqueeze(1)
-                         .expand_as(seq_range_expand))
-    return seq_range_expand < seq_length_expand
+    seq_range = torch.arange(0, int(max_len), device=sequence_length.device).long()
+    return seq_range.unsqueeze(0) < sequence_length.unsqueeze(1)
 
 def cross_entropy(logits, target):
     batch_size = logits.size(0)
@@ -121,37 +115,42 @@ def masked_cross_entropy_for_slot(logits, target, mask, use_softmax=True):
     return loss
 
 def masked_cross_entropy_for_value(logits, target, mask):
-    # logits: b * |s| * m * |v|
+    # logits: b * |s| * m * |v|, probabilities of the pointer-generator mixture
     # target: b * |s| * m
     # mask:   b * |s|
-    logits_flat = logits.view(-1, logits.size(-1)) ## -1 means infered from other dimentions
-    # print(logits_flat.size())
-    log_probs_flat = torch.log(logits_flat)
-    # print("log_probs_flat", log_probs_flat)
-    target_flat = target.view(-1, 1)
-    # print("target_flat", target_flat)
-    losses_flat = -torch.gather(log_probs_flat, dim=1, index=target_flat)
-    losses = losses_flat.view(*target.size()) # b * |s| * m
+    # take the log of the gathered target probabilities only, clamped to avoid log(0)
+    probs = torch.gather(logits, -1, target.unsqueeze(-1)).squeeze(-1) # b * |s| * m
+    losses = -torch.log(probs.clamp(min=1e-12))
     loss = masking(losses, mask)
     return loss
 
+def soft_cross_entropy_for_value(probs, target_prob, target_idx, mask, temperature=1.0):
+    # probs:       b * |s| * m * |v|
+    # target_prob: b * |s| * m * k, top-k probabilities of the teacher
+    # target_idx:  b * |s| * m * k, vocabulary ids of the top-k probabilities
+    # mask:        b * |s|
+    # the pointer-generator mixture has no logits: the log-probabilities take their place, softened by
+    # the temperature for the teacher (over its top-k) and for the student (over the vocabulary) alike
+    target_prob = functional.softmax(torch.log(target_prob.float().clamp(min=1e-12)) / temperature, dim=-1)
+    log_probs = functional.log_softmax(torch.log(probs.clamp(min=1e-12)) / temperature, dim=-1)
+    log_probs = torch.gather(log_probs, -1, target_idx.long())
+    losses = -(target_prob * log_probs).sum(-1) # b * |s| * m
+    loss = masking(losses, mask) * temperature * temperature
+    return loss
+
+def soft_cross_entropy_for_gate(logits, target_logits, temperature=1.0):
+    # logits, target_logits: b * |s| * nb_gate
+    target_prob = functional.softmax(target_logits.float() / temperature, dim=-1)
+    log_probs = functional.log_softmax(logits / temperature, dim=-1)
+    loss = -(target_prob * log_probs).sum(-1).mean() * temperature * temperature
+    return loss
+
 def masking(losses, mask):
-    mask_ = []
-    batch_size = mask.size(0)
-    max_len = losses.size(2)
-    for si in range(mask.size(1)):
-        seq_range = torch.arange(0, max_len).long()
-        seq_range_expand = seq_range.unsqueeze(0).expand(batch_size, max_len)
-        if mask[:,si].is_cuda:
-            seq_range_expand = seq_range_expand.cuda()
-        seq_length_expand = mask[:, si].unsqueeze(1).expand_as(seq_range_expand)
-        mask_.append( (seq_range_expand < seq_length_expand) )
-    mask_ = torch.stack(mask_)
-    mask_ = mask_.transpose(0, 1)
-    if losses.is_cuda:
-        mask_ = mask_.cuda()
-    losses = losses * mask_.float()
-    loss = losses.sum() / (mask_.sum().float())
+    # losses: b * |s| * m
+    # mask:   b * |s|, number of valid decoding steps of each slot
+    seq_range = torch.arange(0, losses.size(2), device=losses.device)
+    mask_ = (seq_range < mask.to(losses.device).unsqueeze(-1)).float() # b * |s| * m
+    loss = (losses * mask_).sum() / mask_.sum()
     return loss
 
 
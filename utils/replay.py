@@ -0,0 +1,108 @@
+import numpy as np
+import torch
+
+
+class ReplayBuffer:
+    """
+    A fixed number (`budget`) of training examples of the old domains, reservoir-sampled so that every
+    example offered by add_dataset() has the same chance to be kept, whatever the size of the data.
+    Examples are kept pre-tokenized as int arrays: the context word ids, the word ids of the value of
+    every slot of `slots` (ending with EOS) and the gating labels, with the context text as utf-8 bytes
+    for the BERT tokenizer. sample() collates a batch of them like the training loader does.
+    """
+    def __init__(self, budget, slots, seed=0):
+        self.budget = budget
+        self.slots = list(slots)
+        self.rng = np.random.RandomState(seed)
+        self.seen = 0
+        self.ID, self.turn_id, self.turn_domain = [], [], []
+        self.context, self.context_plain, self.generate_y, self.value_lengths, self.gating_label = [], [], [], [], []
+
+    def __len__(self):
+        return len(self.context)
+
+    def add_dataset(self, dataset):
+        """Offers every example of a Dataset to the reservoir, only the kept ones are preprocessed."""
+        for index in range(len(dataset)):
+            if self.seen < self.budget:
+                position = self.seen
+            else:
+                position = self.rng.randint(0, self.seen + 1)
+            self.seen += 1
+            if position < self.budget:
+                self.store(position, dataset[index])
+
+    def store(self, position, item):
+        values = [np.asarray(value, dtype=np.int32) for value in item['generate_y']]
+        example = (item['ID'], item['turn_id'], item['turn_domain'],
+                   np.asarray(item['context'], dtype=np.int32),
+                   np.frombuffer(item['context_plain'].encode('utf-8'), dtype=np.uint8),
+                   np.concatenate(values),
+                   np.array([len(value) for value in values], dtype=np.int16),
+                   np.asarray(item['gating_label'], dtype=np.int8))
+        columns = (self.ID, self.turn_id, self.turn_domain, self.context, self.context_plain, self.generate_y,
+                   self.value_lengths, self.gating_label)
+        for column, value in zip(columns, example):
+            if position == len(column):
+                column.append(value)
+            else:
+                column[position] = value
+
+    def item(self, index):
+        """The example `index` in the format of Dataset.__getitem__, for collate_fn."""
+        ends = np.cumsum(self.value_lengths[index])
+        values = np.split(self.generate_y[index], ends[:-1])
+        return {
+            "ID": self.ID[index],
+            "turn_id": self.turn_id[index],
+            "turn_belief": [],
+            "gating_label": self.gating_label[index].tolist(),
+            "context": torch.from_numpy(self.context[index].astype(np.int64)),
+            "context_plain": self.context_plain[index].tobytes().decode('utf-8'),
+            "turn_uttr_plain": "",
+            "turn_domain": self.turn_domain[index],
+            "generate_y": [value.tolist() for value in values],
+        }
+
+    def sample(self, batch_size, collate):
+        """A collated batch of `batch_size` examples drawn without replacement (all of them if fewer)."""
+        indices = self.rng.choice(len(self), min(batch_size, len(self)), replace=False)
+        return collate([self.item(index) for index in indices])
+
+    def save(self, path):
+        """Writes the buffer as one .npz file of flat arrays with their offsets (no pickled objects)."""
+        np.savez(path,
+                 budget=self.budget,
+                 seen=self.seen,
+                 slots=np.array(self.slots),
+                 ID=np.array(self.ID),
+                 turn_id=np.array(self.turn_id, dtype=np.int32),
+                 turn_domain=np.array(self.turn_domain, dtype=np.int8),
+                 context=np.concatenate(self.context) if self.context else np.zeros(0, dtype=np.int32),
+                 context_lengths=np.array([len(c) for c in self.context], dtype=np.int32),
+                 context_plain=np.concatenate(self.context_plain) if self.context_plain else np.zeros(0, dtype=np.uint8),
+                 context_plain_lengths=np.array([len(c) for c in self.context_plain], dtype=np.int32),
+                 generate_y=np.concatenate(self.generate_y) if self.generate_y else np.zeros(0, dtype=np.int32),
+                 generate_y_lengths=np.array([len(y) for y in self.generate_y], dtype=np.int32),
+                 value_lengths=np.array(self.value_lengths, dtype=np.int16).reshape(len(self), len(self.slots)),
+                 gating_label=np.array(self.gating_label, dtype=np.int8).reshape(len(self), len(self.slots)))
+
+    @classmethod
+    def load(cls, path, seed=0):
+        saved = np.load(path)
+        buffer = cls(int(saved['budget']), saved['slots'].tolist(), seed)
+        buffer.seen = int(saved['seen'])
+        buffer.ID = saved['ID'].tolist()
+        buffer.turn_id = saved['turn_id'].tolist()
+        buffer.turn_domain = saved['turn_domain'].tolist()
+        buffer.context = np.split(saved['context'], np.cumsum(saved['context_lengths'])[:-1]) if len(buffer.ID) else []
+        buffer.context_plain = np.split(saved['context_plain'], np.cumsum(saved['context_plain_lengths'])[:-1]) if len(buffer.ID) else []
+        buffer.generate_y = np.split(saved['generate_y'], np.cumsum(saved['generate_y_lengths'])[:-1]) if len(buffer.ID) else []
+        buffer.value_lengths = list(saved['value_lengths'])
+        buffer.gating_label = list(saved['gating_label'])
+        return buffer
+
+    def nbytes(self):
+        """Memory used by the arrays of the examples."""
+        columns = (self.context, self.context_plain, self.generate_y, self.value_lengths, self.gating_label)
+        return sum(a.nbytes for column in columns for a in column)
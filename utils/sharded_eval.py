@@ -0,0 +1,56 @@
+import multiprocessing
+import os
+
+import torch
+
+from utils.utils_multiWOZ_DST import dialogue_shards, subset_loader
+
+# what the forked workers inherit: (model, loader, slot_temp, shards)
+_shared = None
+
+
+def _shard_worker(shard):
+    model, loader, slot_temp, shards = _shared
+    # pin each worker to its own CPU
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+    if len(cpus) >= len(shards):
+        os.sched_setaffinity(0, [cpus[shard]])
+    return model.predict(subset_loader(loader, shards[shard]), slot_temp, 'cpu')
+
+
+def predict_sharded(model, loader, slot_temp, workers):
+    """
+    TRADE.predict() of the examples of `loader` on the CPU, by `workers` forked processes each decoding
+    the turns of a shard of the dialogues with a single intra-op thread.
+    The workers stay single-threaded: GNU libgomp cannot start a thread team in a child forked from a
+    process that already ran one, it hangs. The parent also runs single-threaded while forking.
+    The weights are moved to shared memory first, so the workers read a single copy of them.
+    The predictions are merged in the order of the dialogues in the dataset and of their turns, whatever
+    the shards and their batching.
+    """
+    global _shared
+    dataset = loader.dataset
+    shards = [shard for shard in dialogue_shards(dataset, workers) if shard]
+    model.share_memory()
+    _shared = (model, loader, slot_temp, shards)
+    threads = torch.get_num_threads()
+    torch.set_num_threads(1)
+    try:
+        with multiprocessing.get_context('fork').Pool(len(shards)) as pool:
+            predictions = pool.map(_shard_worker, range(len(shards)))
+    finally:
+        _shared = None
+        torch.set_num_threads(threads)
+
+    merged = {}
+    for prediction in predictions:
+        merged.update(prediction)
+    all_prediction = {}
+    for dialogue in dataset.ID:
+        if dialogue not in all_prediction:
+            all_prediction[dialogue] = dict((turn, merged[dialogue][turn]) for turn in sorted(merged[dialogue]))
+    if getattr(dataset, "carryover", False):
+        dataset.predicted_belief = dict(((dialogue, turn), prediction["pred_bs_ptr"])
+                                        for dialogue, turns in all_prediction.items() for turn, prediction in turns.items())
+    print("Decoded {} dialogues in {} shards".format(len(all_prediction), len(shards)))
+    return all_prediction
@@ -3,9 +3,11 @@ import random
 import torch
 import torch.utils.data as data
 from collections import OrderedDict
+from functools import partial
 from embeddings import GloveEmbedding, KazumaCharEmbedding
 import os
 import pickle
+import time
 from random import shuffle
 
 from utils.config import args, PAD_token, SOS_token, EOS_token, UNK_token
@@ -53,6 +55,7 @@ class Dataset(data.Dataset):
     def __init__(self, data_info, src_word2id, trg_word2id, sequicity, mem_word2id):
         """Reads source and target sequences from txt files."""
         self.ID = data_info['ID']
+        self.domains = data_info['domains']
         self.turn_domain = data_info['turn_domain']
         self.turn_id = data_info['turn_id']
         self.dialog_history = data_info['dialog_history']
@@ -60,6 +63,13 @@ class Dataset(data.Dataset):
         self.gating_label = data_info['gating_label']
         self.turn_uttr = data_info['turn_uttr']
         self.generate_y = data_info["generate_y"]
+        # belief carryover mode: the context is rebuilt from the previous belief state, which is
+        # the gold one during training and the model prediction (filled by TRADE.evaluate) otherwise
+        self.carryover = 'prev_belief' in data_info
+        if self.carryover:
+            self.prev_belief = data_info['prev_belief']
+            self.turn_window = data_info['turn_window']
+            self.predicted_belief = {}
         self.sequicity = sequicity
         self.num_total_seqs = len(self.dialog_history)
         self.src_word2id = src_word2id
@@ -77,9 +87,12 @@ class Dataset(data.Dataset):
         generate_y = self.generate_y[index]
         generate_y = self.preprocess_slot(generate_y, self.trg_word2id)
         context_plain = self.dialog_history[index]
+        if self.carryover:
+            prev_belief = self.predicted_belief.get((ID, turn_id - 1), self.prev_belief[index]) if turn_id > 0 else []
+            context_plain = (serialize_belief(prev_belief) + " " + self.turn_window[index]).strip()
         context = self.preprocess(context_plain, self.src_word2id)
 
-        
+
         item_info = {
             "ID":ID, 
             "turn_id":turn_id, 
@@ -91,10 +104,22 @@ class Dataset(data.Dataset):
             "turn_domain":turn_domain, 
             "generate_y":generate_y,
             }
+        if self.carryover:
+            item_info["prev_belief"] = prev_belief
         return item_info
 
     def __len__(self):
         return self.num_total_seqs
+
+    def context_length(self, index):
+        """Number of words of the context of an example (with the gold previous belief state in carryover mode)."""
+        if self.carryover:
+            length = len(serialize_belief(self.prev_belief[index]).split()) + len(self.turn_window[index].split())
+        else:
+            length = len(self.dialog_history[index].split())
+        if args['max_context_length'] > 0:
+            length = min(length, args['max_context_length'])
+        return max(length, 1)
     
     def preprocess(self, sequence, word2idx):
         """Converts words to ids."""
@@ -128,7 +153,142 @@ class Dataset(data.Dataset):
         return domains[turn_domain]
 
 
+def serialize_belief(belief):
+    """Compact text form of a belief state ("domain slot value ;" for every active slot)."""
+    tokens = []
+    for slot_value in sorted(belief):
+        domain, slot, value = slot_value.split("-", 2)
+        if value == "none":
+            continue
+        tokens.append("{} {} {} ;".format(domain, slot, value))
+    return " ".join(tokens)
+
+
+class TurnOrderedBatchSampler(torch.utils.data.sampler.Sampler):
+    """Batches turns in increasing turn index, so the predictions for turn t-1 of every
+    dialogue are available when turn t is encoded (used to evaluate --carryover_belief).
+    With `indices`, only these examples are batched."""
+
+    def __init__(self, dataset, batch_size, indices=None):
+        self.batch_size = batch_size
+        turns = {}
+        for idx in (range(len(dataset)) if indices is None else indices):
+            turns.setdefault(dataset.turn_id[idx], []).append(idx)
+        self.batches = []
+        for turn_id in sorted(turns.keys()):
+            indices = turns[turn_id]
+            for i in range(0, len(indices), batch_size):
+                self.batches.append(indices[i:i + batch_size])
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class ResumableRandomSampler(torch.utils.data.sampler.Sampler):
+    """Shuffles with a permutation that only depends on the seed and the epoch, so an
+    interrupted epoch can be resumed from the position `start` of the same permutation.
+    In distributed training each of the `num_replicas` processes gets its own shard of the
+    permutation, padded so that all of them run the same number of batches."""
+
+    def __init__(self, dataset, seed, num_replicas=1, rank=0):
+        self.dataset_size = len(dataset)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = (self.dataset_size + num_replicas - 1) // num_replicas
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(self.dataset_size, generator=generator).tolist()
+        indices += indices[:self.num_samples * self.num_replicas - self.dataset_size]
+        indices = indices[self.rank::self.num_replicas]
+        return iter(indices[self.start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+
+class TokenBudgetBatchSampler(torch.utils.data.sampler.Sampler):
+    """Variable-size batches whose padded context size (examples x longest context) stays
+    within `max_tokens`. Examples are shuffled, sorted by length inside pools of
+    `pool_batches` batches so that similar lengths share a batch, and the batch order is
+    shuffled again. Like ResumableRandomSampler the order only depends on the seed and the
+    epoch, and `start` (in batches) resumes an interrupted epoch."""
+
+    def __init__(self, dataset, max_tokens, seed, num_replicas=1, rank=0, pool_batches=100):
+        self.lengths = [dataset.context_length(i) for i in range(len(dataset))]
+        self.max_tokens = max_tokens
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.pool_size = pool_batches * max(1, max_tokens // max(1, int(sum(self.lengths) / len(self.lengths))))
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        indices = torch.randperm(len(self.lengths), generator=generator).tolist()
+        batches = []
+        for p in range(0, len(indices), self.pool_size):
+            pool = sorted(indices[p:p + self.pool_size], key=lambda i: self.lengths[i])
+            batch, max_len = [], 0
+            for i in pool:
+                new_max_len = max(max_len, self.lengths[i])
+                if batch and new_max_len * (len(batch) + 1) > self.max_tokens:
+                    batches.append(batch)
+                    batch, new_max_len = [], self.lengths[i]
+                batch.append(i)
+                max_len = new_max_len
+            if batch:
+                batches.append(batch)
+        order = torch.randperm(len(batches), generator=generator).tolist()
+        batches = [batches[b] for b in order]
+        # every process runs the same number of batches
+        num_batches = len(batches) // self.num_replicas
+        self.batches = batches[self.rank:num_batches * self.num_replicas:self.num_replicas]
+
+    def __iter__(self):
+        return iter(self.batches[self.start:])
+
+    def __len__(self):
+        return len(self.batches) - self.start
+
+
+PLAIN_KEYS = ['ID', 'turn_belief', 'context_plain', 'turn_uttr_plain', 'prev_belief']
+
+def batch_to_device(data, device):
+    """Moves the numerical fields of a collated batch to `device`, keeping the plain text ones as lists."""
+    batch = {}
+    # wrap all numerical values as tensors for multi-gpu training
+    for k, v in data.items():
+        if isinstance(v, torch.Tensor):
+            batch[k] = v.to(device)
+        elif isinstance(v, list):
+            if k in PLAIN_KEYS:
+                batch[k] = v
+            else:
+                batch[k] = torch.tensor(v).to(device)
+        else:
+            # print('v is: {} and this ignoring {}'.format(v, k))
+            pass
+    return batch
+
+
 def collate_fn(data, tokenizer=None):
+    collate_start = time.perf_counter()
+
     def merge(sequences, is_context=False, plain=False):
         '''
         merge from batch * sent_len to batch * max_len 
@@ -217,7 +377,7 @@ def collate_fn(data, tokenizer=None):
     all_segment_ids = None
     all_sub_word_masks = None
 
-    if args['encoder'] == 'BERT':
+    if tokenizer is not None:
         story_plain = context_plain_seqs
         max_seq_length = max(src_lengths)
         # max_seq_length = 512
@@ -238,6 +398,8 @@ def collate_fn(data, tokenizer=None):
     item_info['all_input_mask'] = all_input_mask
     item_info['all_segment_ids'] = all_segment_ids
     item_info['all_sub_word_masks'] = all_sub_word_masks
+    # reported in the training metrics, ignored by batch_to_device
+    item_info['collate_time'] = time.perf_counter() - collate_start
 
     return item_info
 
@@ -297,6 +459,7 @@ def read_langs(file_name, gating_dict, SLOTS, dataset, lang, mem_lang, sequicity
                 continue
 
             # Reading data
+            utterances, last_belief_list = [], []
             for ti, turn in enumerate(dial_dict["dialogue"]):
                 turn_domain = turn["domain"]
                 turn_id = turn["turn_idx"]
@@ -304,23 +467,23 @@ def read_langs(file_name, gating_dict, SLOTS, dataset, lang, mem_lang, sequicity
                 turn_uttr_strip = turn_uttr.strip()
                 dialog_history +=  (turn["system_transcript"] + " ; " + turn["transcript"] + " ; ")
                 source_text = dialog_history.strip()
+                if args["carryover_belief"]:
+                    utterances += [uttr for uttr in (turn["system_transcript"], turn["transcript"]) if uttr.strip()]
+                    turn_window = " ; ".join(utterances[-args["context_window"]:]) + " ;"
+                    source_text = (serialize_belief(last_belief_list) + " " + turn_window).strip()
                 turn_belief_dict = fix_general_label_error(turn["belief_state"], False, SLOTS)
 
                 # Generate domain-dependent slot list
-                slot_temp = SLOTS
+                slot_temp = domain_slots(SLOTS, dataset)
                 if dataset == "train" or dataset == "dev":
                     if args["except_domain"] != "":
-                        slot_temp = [k for k in SLOTS if args["except_domain"] not in k]
                         turn_belief_dict = OrderedDict([(k, v) for k, v in turn_belief_dict.items() if args["except_domain"] not in k])
                     elif args["only_domain"] != "":
-                        slot_temp = [k for k in SLOTS if args["only_domain"] in k]
                         turn_belief_dict = OrderedDict([(k, v) for k, v in turn_belief_dict.items() if args["only_domain"] in k])
                 else:
                     if args["except_domain"] != "":
-                        slot_temp = [k for k in SLOTS if args["except_domain"] in k]
                         turn_belief_dict = OrderedDict([(k, v) for k, v in turn_belief_dict.items() if args["except_domain"] in k])
                     elif args["only_domain"] != "":
-                        slot_temp = [k for k in SLOTS if args["only_domain"] in k]
                         turn_belief_dict = OrderedDict([(k, v) for k, v in turn_belief_dict.items() if args["only_domain"] in k])
 
                 turn_belief_list = [str(k)+'-'+str(v) for k, v in turn_belief_dict.items()]
@@ -331,10 +494,12 @@ def read_langs(file_name, gating_dict, SLOTS, dataset, lang, mem_lang, sequicity
                 class_label, generate_y, slot_mask, gating_label  = [], [], [], []
                 start_ptr_label, end_ptr_label = [], []
                 for slot in slot_temp:
-                    if slot in turn_belief_dict.keys(): 
+                    if slot in turn_belief_dict.keys():
                         generate_y.append(turn_belief_dict[slot])
 
-                        if turn_belief_dict[slot] == "dontcare":
+                        if "carry" in gating_dict and last_belief_dict.get(slot) == turn_belief_dict[slot] != "none":
+                            gating_label.append(gating_dict["carry"])
+                        elif turn_belief_dict[slot] == "dontcare":
                             gating_label.append(gating_dict["dontcare"])
                         elif turn_belief_dict[slot] == "none":
                             gating_label.append(gating_dict["none"])
@@ -359,6 +524,10 @@ def read_langs(file_name, gating_dict, SLOTS, dataset, lang, mem_lang, sequicity
                     "turn_uttr":turn_uttr_strip, 
                     'generate_y':generate_y
                     }
+                if args["carryover_belief"]:
+                    data_detail["prev_belief"] = last_belief_list
+                    data_detail["turn_window"] = turn_window
+                last_belief_dict, last_belief_list = turn_belief_dict, turn_belief_list
                 data.append(data_detail)
                 
                 if max_resp_len < len(source_text.split()):
@@ -393,20 +562,90 @@ def get_seq(pairs, lang, mem_lang, batch_size, type, sequicity, tokenizer=None):
 
     dataset = Dataset(data_info, lang.word2index, lang.word2index, sequicity, mem_lang.word2index)
 
-    if args["imbalance_sampler"] and type:
+    # training data is sharded among the processes of distributed training
+    num_replicas, rank = 1, 0
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        num_replicas, rank = torch.distributed.get_world_size(), torch.distributed.get_rank()
+
+    if args["carryover_belief"] and not type:
+        data_loader = torch.utils.data.DataLoader(dataset=dataset,
+                                                  batch_sampler=TurnOrderedBatchSampler(dataset, batch_size),
+                                                  collate_fn=partial(collate_fn, tokenizer=tokenizer))
+    elif args["imbalance_sampler"] and type:
         data_loader = torch.utils.data.DataLoader(dataset=dataset,
                                                   batch_size=batch_size,
                                                   # shuffle=type,
-                                                  collate_fn=lambda data: collate_fn(data, tokenizer),
+                                                  collate_fn=partial(collate_fn, tokenizer=tokenizer),
                                                   sampler=ImbalancedDatasetSampler(dataset))
+    elif type and args["batch_tokens"] > 0:
+        data_loader = torch.utils.data.DataLoader(dataset=dataset,
+                                                  batch_sampler=TokenBudgetBatchSampler(dataset, args["batch_tokens"], args['seed'], num_replicas, rank),
+                                                  collate_fn=partial(collate_fn, tokenizer=tokenizer),
+                                                  generator=torch.Generator())
+    elif type:
+        data_loader = torch.utils.data.DataLoader(dataset=dataset,
+                                                  batch_size=batch_size,
+                                                  collate_fn=partial(collate_fn, tokenizer=tokenizer),
+                                                  sampler=ResumableRandomSampler(dataset, args['seed'], num_replicas, rank),
+                                                  # own generator: iterating must not draw from the global RNG saved in checkpoints
+                                                  generator=torch.Generator())
     else:
         data_loader = torch.utils.data.DataLoader(dataset=dataset,
                                                   batch_size=batch_size,
                                                   shuffle=type,
-                                                  collate_fn=lambda data: collate_fn(data, tokenizer))
+                                                  collate_fn=partial(collate_fn, tokenizer=tokenizer))
     return data_loader
 
 
+def stratified_dialogues(dataset, ratio, seed):
+    """
+    Example indices of a fixed sample of about `ratio` of the dialogues of `dataset`, drawn
+    separately among the dialogues of each combination of domains so that all are represented.
+    """
+    strata = {}
+    for idx, (dialogue, domains) in enumerate(zip(dataset.ID, dataset.domains)):
+        strata.setdefault(tuple(sorted(domains)), OrderedDict()).setdefault(dialogue, []).append(idx)
+    rng = random.Random(seed)
+    indices = []
+    for key in sorted(strata.keys()):
+        dialogues = list(strata[key].values())
+        for turns in rng.sample(dialogues, max(1, int(round(ratio * len(dialogues))))):
+            indices += turns
+    return sorted(indices)
+
+
+def dialogue_shards(dataset, num_shards):
+    """
+    Example indices of `num_shards` shards of the dialogues of `dataset`, with about as many turns each:
+    the dialogues, longest first, go to the shard with the fewest turns so far.
+    """
+    dialogues = OrderedDict()
+    for idx, dialogue in enumerate(dataset.ID):
+        dialogues.setdefault(dialogue, []).append(idx)
+    shards = [[] for _ in range(num_shards)]
+    for turns in sorted(dialogues.values(), key=len, reverse=True):
+        min(shards, key=len).extend(turns)
+    return [sorted(shard) for shard in shards]
+
+
+def proxy_loader(loader, ratio, seed):
+    """Loader over the examples of stratified_dialogues() of an evaluation loader, batched the same way."""
+    return subset_loader(loader, stratified_dialogues(loader.dataset, ratio, seed))
+
+
+def subset_loader(loader, indices):
+    """Loader over the examples `indices` of an evaluation loader, batched the same way."""
+    dataset = loader.dataset
+    if isinstance(loader.batch_sampler, TurnOrderedBatchSampler):
+        return torch.utils.data.DataLoader(dataset=dataset,
+                                           batch_sampler=TurnOrderedBatchSampler(dataset, loader.batch_sampler.batch_size, indices),
+                                           collate_fn=loader.collate_fn)
+    return torch.utils.data.DataLoader(dataset=dataset,
+                                       batch_size=loader.batch_size,
+                                       sampler=indices,
+                                       collate_fn=loader.collate_fn)
+
+
 def dump_pretrained_emb(word2index, index2word, dump_path):
     print("Dumping pretrained embeddings...")
     # import ssl
@@ -428,8 +667,74 @@ def get_slot_information(ontology):
     SLOTS = [k.replace(" ","").lower() if ("book" not in k) else k.lower() for k in ontology_domains.keys()]
     return SLOTS
 
+def load_slots():
+    """The domain-slot pairs of the ontology, and the gating dict of the model."""
+    ontology = json.load(open(args['data_dir'] + "/multi-woz/MULTIWOZ2.1/ontology.json", 'r'))
+    ALL_SLOTS = get_slot_information(ontology)
+    gating_dict = {"ptr":0, "dontcare":1, "none":2}
+    if args["carryover_belief"]:
+        # slots whose value is unchanged since the previous turn are copied, not generated
+        gating_dict["carry"] = 3
+    return ALL_SLOTS, gating_dict
+
+def domain_slots(SLOTS, dataset):
+    """The slots decoded on the "train", "dev" or "test" data with -exceptd or -onlyd."""
+    if dataset == "train" or dataset == "dev":
+        if args["except_domain"] != "":
+            return [k for k in SLOTS if args["except_domain"] not in k]
+        elif args["only_domain"] != "":
+            return [k for k in SLOTS if args["only_domain"] in k]
+    else:
+        if args["except_domain"] != "":
+            return [k for k in SLOTS if args["except_domain"] in k]
+        elif args["only_domain"] != "":
+            return [k for k in SLOTS if args["only_domain"] in k]
+    return SLOTS
 
-def prepare_data_seq(training, task="dst", sequicity=0, batch_size=100):
+def load_langs(folder_name):
+    """The lang and mem_lang vocabularies saved in `folder_name` when the model was trained."""
+    lang_name = 'lang-all.pkl' if args["all_vocab"] else 'lang-train.pkl'
+    mem_lang_name = 'mem-lang-all.pkl' if args["all_vocab"] else 'mem-lang-train.pkl'
+    with open(folder_name+lang_name, 'rb') as handle:
+        lang = pickle.load(handle)
+    with open(folder_name+mem_lang_name, 'rb') as handle:
+        mem_lang = pickle.load(handle)
+    return lang, mem_lang
+
+
+# settings that change the output of read_langs, a --data_cache built with other values is rebuilt
+DATA_CACHE_ARGS = ['all_vocab', 'carryover_belief', 'context_window', 'data_ratio', 'except_domain', 'only_domain', 'except_domain_dev']
+
+def data_cache_key(files):
+    key = dict((k, args[k]) for k in DATA_CACHE_ARGS)
+    key['files'] = [(os.path.abspath(f), os.path.getsize(f), os.path.getmtime(f)) for f in files]
+    return key
+
+def load_data_cache(path, key):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, 'rb') as handle:
+        cache = pickle.load(handle)
+    if cache['key'] != key:
+        print("[Info] {} was built with other data settings, rebuilding it".format(path))
+        return None
+    print("[Info] Loading preprocessed data from {}".format(path))
+    return cache['data']
+
+def save_data_cache(path, key, data):
+    # several trials of a sweep may build it at the same time, the last rename wins
+    tmp_path = '{}.tmp{}'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as handle:
+        pickle.dump({'key': key, 'data': data}, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    print("[Info] Preprocessed data saved to {}".format(path))
+
+def prepare_data_seq(training, task="dst", sequicity=0, batch_size=100, langs=None):
+    """
+    The train, dev and test loaders. For testing, `langs` are the [lang, mem_lang] vocabularies of the model
+    (of a model artifact), instead of the lang files saved when it was trained.
+    """
+    # the BERT features of a distillation teacher are computed by its own loaders, see utils.distill
     if args['encoder'] == 'BERT':
         tokenizer = BertTokenizer.from_pretrained(args['bert_model'], do_lower_case=args['do_lower_case'])
     else:
@@ -448,9 +753,7 @@ def prepare_data_seq(training, task="dst", sequicity=0, batch_size=100):
     if not os.path.exists(folder_name): 
         os.makedirs(folder_name)
     # load domain-slot pairs from ontology
-    ontology = json.load(open(args['data_dir'] + "/multi-woz/MULTIWOZ2.1/ontology.json", 'r'))
-    ALL_SLOTS = get_slot_information(ontology)
-    gating_dict = {"ptr":0, "dontcare":1, "none":2}
+    ALL_SLOTS, gating_dict = load_slots()
     # Vocabulary
     lang, mem_lang = Lang(), Lang()
     lang.index_words(ALL_SLOTS, 'slot')
@@ -460,19 +763,31 @@ def prepare_data_seq(training, task="dst", sequicity=0, batch_size=100):
 
 
     if training:
-        pair_train, train_max_len, slot_train = read_langs(file_train, gating_dict, ALL_SLOTS, "train", lang, mem_lang, sequicity, training)
+        # the parsed dialogues and the vocabulary can be shared by several runs through --data_cache
+        cache_key = data_cache_key([file_train, file_dev, file_test]) if args['data_cache'] else None
+        cache = load_data_cache(args['data_cache'], cache_key)
+        if cache is None:
+            pair_train, train_max_len, slot_train = read_langs(file_train, gating_dict, ALL_SLOTS, "train", lang, mem_lang, sequicity, training)
+            nb_train_vocab = lang.n_words
+            pair_dev, dev_max_len, slot_dev = read_langs(file_dev, gating_dict, ALL_SLOTS, "dev", lang, mem_lang, sequicity, training)
+            pair_test, test_max_len, slot_test = read_langs(file_test, gating_dict, ALL_SLOTS, "test", lang, mem_lang, sequicity, training)
+            if args['data_cache']:
+                save_data_cache(args['data_cache'], cache_key, (
+                    pair_train, train_max_len, slot_train, nb_train_vocab,
+                    pair_dev, dev_max_len, slot_dev,
+                    pair_test, test_max_len, slot_test,
+                    lang, mem_lang))
+        else:
+            (pair_train, train_max_len, slot_train, nb_train_vocab,
+             pair_dev, dev_max_len, slot_dev,
+             pair_test, test_max_len, slot_test,
+             lang, mem_lang) = cache
         train = get_seq(pair_train, lang, mem_lang, batch_size, True, sequicity, tokenizer)
-        nb_train_vocab = lang.n_words
-        pair_dev, dev_max_len, slot_dev = read_langs(file_dev, gating_dict, ALL_SLOTS, "dev", lang, mem_lang, sequicity, training)
         dev   = get_seq(pair_dev, lang, mem_lang, eval_batch, False, sequicity, tokenizer)
-        pair_test, test_max_len, slot_test = read_langs(file_test, gating_dict, ALL_SLOTS, "test", lang, mem_lang, sequicity, training)
         test  = get_seq(pair_test, lang, mem_lang, eval_batch, False, sequicity, tokenizer)
         if os.path.exists(folder_name+lang_name) and os.path.exists(folder_name+mem_lang_name):
             print("[Info] Loading saved lang files...")
-            with open(folder_name+lang_name, 'rb') as handle: 
-                lang = pickle.load(handle)
-            with open(folder_name+mem_lang_name, 'rb') as handle: 
-                mem_lang = pickle.load(handle)
+            lang, mem_lang = load_langs(folder_name)
         else:
             print("[Info] Dumping lang files...")
             with open(folder_name+lang_name, 'wb') as handle: 
@@ -483,10 +798,10 @@ def prepare_data_seq(training, task="dst", sequicity=0, batch_size=100):
         if not os.path.exists(emb_dump_path) and args["load_embedding"]:
             dump_pretrained_emb(lang.word2index, lang.index2word, emb_dump_path)
     else:
-        with open(folder_name+lang_name, 'rb') as handle:
-            lang = pickle.load(handle)
-        with open(folder_name+mem_lang_name, 'rb') as handle:
-            mem_lang = pickle.load(handle)
+        if langs is not None:
+            lang, mem_lang = langs
+        else:
+            lang, mem_lang = load_langs(folder_name)
 
         pair_train, train_max_len, slot_train, train, nb_train_vocab = [], 0, {}, [], 0
         pair_dev, dev_max_len, slot_dev = read_langs(file_dev, gating_dict, ALL_SLOTS, "dev", lang, mem_lang, sequicity, training)